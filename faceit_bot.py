@@ -1,19 +1,38 @@
+import asyncio
+import cProfile
+import functools
+import hashlib
+import heapq
+import html
 import json
+import math
 import os
+import pstats
 import random
+import shutil
+import sqlite3
+import sys
+import tempfile
 import time
-from dataclasses import dataclass, asdict
-from typing import Dict, Any, List, Optional
+import weakref
+from dataclasses import dataclass, field, replace
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from itertools import combinations
+from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 
 # ════════════════════════════════════════════════
 #                    НАСТРОЙКИ
@@ -23,32 +42,134 @@ BOT_TOKEN   = "7818313573:AAHTfCBvQEELEtsG7BRvIcNrxgJ9dckBmlI"   # ← вста
 ADMIN_IDS   = [5839642306]         # ← твои Telegram ID
 DATA_FILE   = "faceit_db.json"
 
+JOURNAL_FILE = "faceit_db.journal"
+SQLITE_FILE  = "faceit_db.sqlite3"
+DB_BACKEND   = "json"        # "json" — снимок + журнал, "sqlite" — SQLITE_FILE
+
+DB_COMPACT_INTERVAL = 60.0   # секунд между свёртками журнала в снимок
+JOURNAL_MAX_RECORDS = 5000   # свернуть досрочно, если журнал вырос больше
+JOURNAL_FSYNC       = False  # fsync после каждой записи (надёжнее, но медленнее)
+
 MAPS_LIST       = ["Dust2", "Inferno", "Mirage", "Nuke", "Overpass", "Anubis", "Vertigo"]
 LOBBY_5V5_SIZE  = 10
 LOBBY_2V2_SIZE  = 4
 PICK_TIMEOUT    = 60   # секунд на пик/бан
+BAN_TIMEOUT     = 60   # секунд на фазу банов карт
+BOT_TURN_DELAY  = 2.0  # секунд «раздумья» тестового бота-капитана
+
+# Что делать, когда капитаны не успели с пиком:
+# "cancel" — отменить матч и вернуть игроков в очередь, "auto" — допикать случайно.
+# Не успели с банами — оставшиеся карты банятся случайно.
+PICK_TIMEOUT_ACTION = "cancel"
+
+# Подбор лобби: "elo" — по близости рейтинга, "fifo" — первые в очереди.
+# В режиме "elo" допустимый разброс ELO в лобби растёт с ожиданием самого
+# давнего игрока: MM_BASE_SPREAD + MM_SPREAD_PER_SEC * секунд ожидания,
+# а после MM_MAX_WAIT секунд ограничение снимается совсем.
+MATCHMAKING        = "elo"
+MM_BASE_SPREAD     = 200
+MM_SPREAD_PER_SEC  = 5.0
+MM_MAX_WAIT        = 180
+MM_TICK_INTERVAL   = 10    # секунд между повторными попытками собрать лобби
+
+# Автобаланс вместо драфта капитанов: составы делятся по ELO сразу,
+# матч начинается с банов карт. Значения по умолчанию — админ
+# переключает режим командой /automode, выбор хранится в базе.
+AUTO_BALANCE = {"5v5": False, "2v2": False}
+
+ELO_START = 1000
+ELO_MIN   = 100
+
+# Модель рейтинга по умолчанию (админ меняет её командой /recalc):
+# "elo"     — Elo по средним рейтингам команд, K у каждого игрока свой;
+# "glicko2" — Glicko-2 с отклонением рейтинга (rd) и волатильностью (vol);
+# "flat"    — фиксированные +ELO_WIN / -ELO_LOSS, как раньше.
+RATING_MODEL   = "elo"
+MATCH_LOG_FILE = "faceit_matches.jsonl"   # итоги матчей для пересчёта рейтинга
 
 ELO_WIN  = 25
 ELO_LOSS = 20
-ELO_MIN  = 100
+
+ELO_K                 = 32
+ELO_K_PROVISIONAL     = 48   # K для новичков — первые ELO_PROVISIONAL_GAMES матчей
+ELO_PROVISIONAL_GAMES = 10
+
+GLICKO_RD     = 350.0   # стартовое (и максимальное) отклонение рейтинга
+GLICKO_RD_MIN = 30.0
+GLICKO_VOL    = 0.06
+GLICKO_TAU    = 0.5
+
+ELO_PAGE_SIZE = 30   # строк на страницу в /elo
+
+RENDER_CACHE_SIZE = 512   # готовых текстов лобби, пиков и рейтингов в памяти
+
+STATS_ELO_POINTS = 20   # сколько последних значений ELO хранить для графика в /stats
+
+SANCTION_SWEEP_INTERVAL = 30.0   # секунд между чистками истёкших мутов/банов
+
+# Параллельная обработка апдейтов. Апдейты одного чата всё равно
+# обрабатываются строго по порядку, разные чаты — параллельно.
+CONCURRENT_UPDATES = True
+UPDATE_WORKERS     = 16    # одновременно выполняемых обработчиков
+UPDATE_BACKLOG     = 256   # сколько апдейтов может ждать своей очереди
+
+# Приём апдейтов: без WEBHOOK_URL — long polling, с ним — вебхук на
+# встроенном HTTP-сервере (нужен процесс, до которого доходит HTTP,
+# например web в Procfile). Апдейты, пришедшие во время рестарта,
+# не выбрасываются в обоих режимах.
+WEBHOOK_URL    = os.environ.get("WEBHOOK_URL", "")   # https://example.com — без пути
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT   = int(os.environ.get("PORT", "8443"))
+WEBHOOK_PATH   = "telegram"
+# Telegram присылает его в X-Telegram-Bot-Api-Secret-Token, чужие запросы отбрасываются.
+# По умолчанию выводится из токена — одинаков между рестартами.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+UPDATE_MODE    = "webhook" if WEBHOOK_URL else "polling"
+
+# Правки сообщений лобби: пачка нажатий за EDIT_WINDOW секунд схлопывается
+# в одну правку. Telegram режет частые правки — держим паузу на чат
+# и общий темп бота.
+EDIT_WINDOW        = 0.5    # секунд копить правки одного сообщения
+EDIT_CHAT_INTERVAL = 1.0    # секунд между правками в одном чате
+EDIT_GLOBAL_RATE   = 25.0   # правок в секунду на всего бота
+EDIT_MAX_RETRIES   = 3      # повторов после RetryAfter
+EDIT_SENT_CACHE    = 1024   # сколько последних показанных версий помнить
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+# (0 — не поднимать HTTP-эндпоинт, /perf работает всё равно)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+
+# /profile: cProfile вокруг обработчиков на ограниченное окно
+PROFILE_DIR     = "profiles"
+PROFILE_UPDATES = 200    # апдейтов по умолчанию
+PROFILE_SECONDS = 60.0   # но не дольше
+PROFILE_TOP     = 15     # строк в каждой таблице сводки
 
 # Тестовые боты получают отрицательные ID начиная с -100001
 BOT_ID_START = -100000
 
 # ════════════════════════════════════════════════
-#                   ДАТАКЛАСС
+#                   ДАТАКЛАССЫ
 # ════════════════════════════════════════════════
+#
+# В памяти игроки и активные матчи живут объектами Player и Match
+# (__slots__: без __dict__ на каждый экземпляр). Словари — только формат
+# хранилища: from_dict()/to_dict() вызываются при загрузке базы и при
+# записи изменений, обработчики работают с атрибутами.
 
-@dataclass
+@dataclass(slots=True)
 class Player:
     user_id:     int
     nickname:    str
     external_id: str   = ""
-    elo:         int   = 1000
+    elo:         int   = ELO_START
     wins:        int   = 0
     losses:      int   = 0
     avg:         float = 0.0
     is_bot:      bool  = False   # тестовый бот — не попадает в /top, /stats, /elo
+    rd:          float = GLICKO_RD    # отклонение рейтинга (Glicko-2)
+    vol:         float = GLICKO_VOL   # волатильность рейтинга (Glicko-2)
 
     def lvl_icon(self) -> str:
         if self.elo >= 2000: return "💎"
@@ -62,12 +183,401 @@ class Player:
             return f"🤖 <b>{self.nickname}</b>"
         return f'<a href="tg://user?id={self.user_id}">{self.nickname}</a>'
 
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Player":
+        """Из записи хранилища; недостающие поля (старые базы) — по умолчанию."""
+        g = d.get
+        return cls(d["user_id"], d["nickname"], g("external_id", ""), g("elo", ELO_START),
+                   g("wins", 0), g("losses", 0), g("avg", 0.0), g("is_bot", False),
+                   g("rd", GLICKO_RD), g("vol", GLICKO_VOL))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_id": self.user_id, "nickname": self.nickname, "external_id": self.external_id,
+            "elo": self.elo, "wins": self.wins, "losses": self.losses, "avg": self.avg,
+            "is_bot": self.is_bot, "rd": self.rd, "vol": self.vol,
+        }
+
+
+@dataclass(slots=True)
+class Match:
+    """Активный матч: драфт (phase="pick"), баны карт ("ban"), игра."""
+    mode:            str
+    ct:              List[int]
+    t:               List[int]
+    pool:            List[int]
+    turn:            int
+    chat_id:         int
+    phase:           str             = "pick"
+    maps:            List[str]       = field(default_factory=lambda: MAPS_LIST.copy())
+    banned_maps:     List[str]       = field(default_factory=list)
+    pick_start_time: float           = field(default_factory=time.time)
+    pick_timeout:    int             = PICK_TIMEOUT
+    ban_timeout:     int             = BAN_TIMEOUT
+    ban_start_time:  Optional[float] = None
+    live_time:       Optional[float] = None
+    rev:             int             = 0    # ревизия для match_cas
+    auto_balance:    bool            = False
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Match":
+        g = d.get
+        return cls(d["mode"], d["ct"], d["t"], d["pool"], d["turn"], g("chat_id", 0),
+                   g("phase", "pick"), d["maps"], g("banned_maps", []),
+                   g("pick_start_time", 0.0), g("pick_timeout", PICK_TIMEOUT),
+                   g("ban_timeout", BAN_TIMEOUT), g("ban_start_time"), g("live_time"),
+                   g("rev", 0), g("auto_balance", False))
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {
+            "mode": self.mode, "ct": self.ct[:], "t": self.t[:], "pool": self.pool[:],
+            "turn": self.turn, "phase": self.phase, "maps": self.maps[:],
+            "banned_maps": self.banned_maps[:], "pick_start_time": self.pick_start_time,
+            "pick_timeout": self.pick_timeout, "ban_timeout": self.ban_timeout,
+            "chat_id": self.chat_id, "rev": self.rev,
+        }
+        if self.ban_start_time is not None:
+            d["ban_start_time"] = self.ban_start_time
+        if self.live_time is not None:
+            d["live_time"] = self.live_time
+        if self.auto_balance:
+            d["auto_balance"] = True
+        return d
+
+
+def to_storage(v: Any) -> Any:
+    """Значение из резидентной базы → JSON-совместимое (для записей и снимков)."""
+    return v.to_dict() if isinstance(v, (Player, Match)) else v
+
+
+def decode_db(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Словари хранилища → Player/Match. Уже декодированное не трогает."""
+    for coll, cls in (("players", Player), ("active_matches", Match)):
+        items = data.get(coll, {})
+        for k, v in items.items():
+            if isinstance(v, dict):
+                items[k] = cls.from_dict(v)
+    return data
+
+# ════════════════════════════════════════════════
+#                    МЕТРИКИ
+# ════════════════════════════════════════════════
+#
+# Счётчики и гистограммы в памяти процесса. Снаружи видны в формате
+# Prometheus на http://METRICS_HOST:METRICS_PORT/metrics и админу
+# через /perf. На горячем пути — только сложение и bisect.
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)   # последний — +Inf
+        self.sum    = 0.0
+        self.count  = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(METRIC_BUCKETS, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка квантиля по корзинам — верхняя граница нужной корзины."""
+        need, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= need and n:
+                return METRIC_BUCKETS[i] if i < len(METRIC_BUCKETS) else float("inf")
+        return 0.0
+
+
+class Metrics:
+
+    def __init__(self):
+        self.counters:   Dict[Tuple[str, Tuple], float]     = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.gauges:     Dict[str, Any] = {}   # имя → функция: число или {метка: число}
+        self.help:       Dict[str, str] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        h   = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = Histogram()
+        return h
+
+    def gauge(self, name: str, fn, help: str = "") -> None:
+        self.gauges[name] = fn
+        if help:
+            self.help[name] = help
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (version 0.0.4)."""
+        out, typed = [], set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    out.append(f"# HELP {name} {self.help[name]}")
+                out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in sorted(self.counters.items()):
+            header(name, "counter")
+            out.append(f"{name}{self._labels(labels)} {v}")
+        for (name, labels), h in sorted(self.histograms.items(), key=lambda kv: kv[0]):
+            header(name, "histogram")
+            cum = 0
+            for bound, n in zip(METRIC_BUCKETS + ("+Inf",), h.counts):
+                cum += n
+                le   = f'le="{bound}"'
+                out.append(f"{name}_bucket{self._labels(labels, le)} {cum}")
+            out.append(f"{name}_sum{self._labels(labels)} {h.sum}")
+            out.append(f"{name}_count{self._labels(labels)} {h.count}")
+        for name, fn in self.gauges.items():
+            try:
+                v = fn()
+            except Exception:
+                continue
+            header(name, "gauge")
+            if isinstance(v, dict):
+                for label, val in v.items():
+                    out.append(f'{name}{{{label}}} {val}')
+            else:
+                out.append(f"{name} {v}")
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+METRICS.help.update({
+    "faceit_handler_seconds":        "Время выполнения обработчика",
+    "faceit_handler_errors_total":   "Исключения в обработчиках",
+    "faceit_db_loads_total":         "Чтения базы из хранилища",
+    "faceit_db_load_bytes_total":    "Байт прочитано при загрузке базы",
+    "faceit_db_writes_total":        "Пачек изменений, записанных в хранилище",
+    "faceit_db_records_total":       "Записей изменений, записанных в хранилище",
+    "faceit_db_write_bytes_total":   "Байт записано в журнал/WAL",
+    "faceit_db_write_seconds":       "Время записи пачки изменений",
+    "faceit_db_compactions_total":   "Свёрток журнала",
+    "faceit_db_compact_bytes_total": "Байт записано при свёртках",
+    "faceit_api_seconds":            "Время запроса к Bot API",
+    "faceit_api_failures_total":     "Неуспешные запросы к Bot API",
+})
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, который меряет каждый вызов Bot API и считает ошибки."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            METRICS.inc("faceit_api_failures_total", endpoint=endpoint, reason=type(e).__name__)
+            raise
+        finally:
+            METRICS.histogram("faceit_api_seconds", endpoint=endpoint).observe(time.perf_counter() - t0)
+        if code >= 400:
+            METRICS.inc("faceit_api_failures_total", endpoint=endpoint, reason=str(code))
+        return code, payload
+
+
+def _timed_handler(callback):
+    name = callback.__name__
+    hist = METRICS.histogram("faceit_handler_seconds", handler=name)
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            METRICS.inc("faceit_handler_errors_total", handler=name)
+            raise
+        finally:
+            hist.observe(time.perf_counter() - t0)
+    return timed
+
+
+def instrument_handlers(app: Application) -> None:
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = _timed_handler(h.callback)
+
+
+async def _metrics_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Минимальный HTTP: GET /metrics → текст Prometheus, остальное — 404."""
+    try:
+        request = (await reader.readline()).split()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if len(request) > 1 and request[1] == b"/metrics":
+            status, body = "200 OK", METRICS.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+# ════════════════════════════════════════════════
+#                 ПРОФИЛИРОВАНИЕ
+# ════════════════════════════════════════════════
+#
+# /profile подменяет колбэки всех обработчиков обёртками с cProfile
+# на N апдейтов или T секунд, а потом возвращает исходные объекты.
+# Пока профилирование выключено, в обработке апдейта нет ни одной
+# лишней проверки — обёрток просто не существует.
+
+class HandlerProfiler:
+
+    def __init__(self):
+        self.profile:   Optional[cProfile.Profile] = None
+        self.originals: Dict[Any, Any] = {}
+        self.remaining = 0
+        self.updates   = 0
+        self.started   = 0.0
+        self.chat_id:  Optional[int] = None
+        self._running  = 0   # обработчиков внутри окна прямо сейчас
+        self._finish:  Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self.profile is not None
+
+    def start(self, app: Application, updates: int, seconds: float, chat_id: int) -> None:
+        self.profile   = cProfile.Profile()
+        self.remaining = updates
+        self.updates   = 0
+        self.started   = time.perf_counter()
+        self.chat_id   = chat_id
+        self._running  = 0
+        for handlers in app.handlers.values():
+            for h in handlers:
+                self.originals[h] = h.callback
+                h.callback = self._wrap(app, h.callback, self.profile)
+        app.job_queue.run_once(self._timeout_job, seconds, name="profile")
+
+    def _wrap(self, app: Application, callback, profile: cProfile.Profile):
+        @functools.wraps(callback)
+        async def profiled(update, context):
+            # Окно закрыто (например, этим же апдейтом /profile stop) —
+            # счётчики и профиль принадлежат уже другой сессии, не трогаем их
+            if self.profile is not profile:
+                return await callback(update, context)
+            # Апдейты идут параллельно: профиль включён, пока внутри есть хоть один
+            if not self._running:
+                profile.enable()
+            self._running += 1
+            try:
+                return await callback(update, context)
+            finally:
+                if self.profile is profile:
+                    self._running -= 1
+                    if not self._running:
+                        profile.disable()
+                    self.updates   += 1
+                    self.remaining -= 1
+                    if self.remaining <= 0 and self._finish is None:
+                        self._finish = asyncio.create_task(self.finish(app))
+        return profiled
+
+    async def _timeout_job(self, context: ContextTypes.DEFAULT_TYPE):
+        if self.active and self._finish is None:
+            self._finish = asyncio.create_task(self.finish(context.application))
+
+    def stop(self, app: Application) -> Optional[cProfile.Profile]:
+        """Возвращает исходные колбэки и отдаёт собранный профиль."""
+        for h, callback in self.originals.items():
+            h.callback = callback
+        self.originals.clear()
+        for job in app.job_queue.get_jobs_by_name("profile"):
+            job.schedule_removal()
+        profile, self.profile = self.profile, None
+        if profile is not None:
+            profile.disable()
+        self._running = 0
+        return profile
+
+    async def finish(self, app: Application) -> None:
+        try:
+            profile = self.stop(app)
+            if profile is None:
+                return
+            elapsed = time.perf_counter() - self.started
+            profile.create_stats()
+            if not profile.stats:
+                await app.bot.send_message(
+                    self.chat_id, "🔬 Профиль пуст: за окно не выполнился ни один обработчик."
+                )
+                return
+            summary, path = self.report(profile)
+            await app.bot.send_message(
+                self.chat_id,
+                f"🔬 <b>Профиль</b>: {self.updates} апдейтов за {elapsed:.1f} с\n"
+                f"<pre>{html.escape(summary)}</pre>\nФайл: <code>{html.escape(path)}</code>",
+                parse_mode=ParseMode.HTML
+            )
+        except Exception as e:
+            print(f"⚠️ Не удалось выгрузить профиль: {e}")
+            try:
+                await app.bot.send_message(self.chat_id, f"⚠️ Не удалось выгрузить профиль: {e}")
+            except Exception:
+                pass
+        finally:
+            self._finish = None
+
+    @staticmethod
+    def report(profile: cProfile.Profile) -> Tuple[str, str]:
+        """Пишет .prof и .txt в PROFILE_DIR, возвращает краткую сводку и путь."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, datetime.now().strftime("profile_%Y%m%d_%H%M%S"))
+        profile.dump_stats(base + ".prof")
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(100)
+
+        stats = pstats.Stats(profile).stats
+        def label(func):
+            file, line, name = func
+            return f"{os.path.basename(file)}:{line}({name})" if line else name
+
+        def top(col: int):
+            rows = sorted(stats.items(), key=lambda kv: -kv[1][col])[:PROFILE_TOP]
+            return [f"{v[col]:7.3f}s {v[1]:>7} {label(k)[:60]}" for k, v in rows]
+
+        lines = ["По общему времени (cumtime, вызовов):", *top(3),
+                 "", "По собственному времени (tottime, вызовов):", *top(2)]
+        return "\n".join(lines), base + ".prof"
+
+
+PROFILER = HandlerProfiler()
+
 # ════════════════════════════════════════════════
 #                  БАЗА ДАННЫХ
 # ════════════════════════════════════════════════
 
-def load_db() -> Dict[str, Any]:
-    default: Dict[str, Any] = {
+def default_db() -> Dict[str, Any]:
+    return {
         "players":        {},
         "match_counter":  0,
         "active_matches": {},
@@ -76,56 +586,1487 @@ def load_db() -> Dict[str, Any]:
         "muted":          {},
         "banned":         {},
         "bot_counter":    0,
+        "lobbies":        {},
+        "queue_joins":    {},   # uid → {"mode", "chat", "ts"}: откуда и когда встал в очередь
     }
-    if not os.path.exists(DATA_FILE):
-        return default
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        for k, v in default.items():
-            data.setdefault(k, v)
+
+
+def apply_record(data: Dict[str, Any], rec: Dict[str, Any]) -> None:
+    """
+    Применяет одну запись изменения к базе в памяти:
+        {"op": "put", "c": "players", "k": "123", "v": {...}}
+        {"op": "del", "c": "players", "k": "123"}
+        {"op": "set", "k": "queue_5v5", "v": [...]}
+    """
+    op = rec["op"]
+    if op == "put":
+        data.setdefault(rec["c"], {})[rec["k"]] = rec["v"]
+    elif op == "del":
+        data.setdefault(rec["c"], {}).pop(rec["k"], None)
+    elif op == "set":
+        data[rec["k"]] = rec["v"]
+
+
+def dump_records(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Представляет всю базу набором записей (для миграции между хранилищами)."""
+    recs = []
+    for k, v in data.items():
+        if isinstance(v, dict):
+            recs.extend({"op": "put", "c": k, "k": kk, "v": to_storage(vv)} for kk, vv in v.items())
+        else:
+            recs.append({"op": "set", "k": k, "v": v})
+    return recs
+
+
+def snapshot_db(data: Dict[str, Any]) -> Any:
+    """
+    Отвязанная от резидентной базы JSON-совместимая копия — её можно
+    сериализовать в другом потоке, пока обработчики меняют базу.
+    """
+    if isinstance(data, (Player, Match)):
+        return data.to_dict()   # Match.to_dict копирует свои списки
+    if isinstance(data, dict):
+        return {k: snapshot_db(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [snapshot_db(v) for v in data]
+    return data
+
+
+class JsonStorage:
+    """
+    Снимок (DATA_FILE) + журнал изменений (JOURNAL_FILE).
+
+    Каждое изменение дописывается в журнал маленькой записью, поэтому
+    цена записи зависит от размера изменения, а не от размера базы.
+    Свёртка в два шага: rotate() в цикле событий откладывает журнал
+    в .old и начинает новый, write_snapshot() (можно в отдельном
+    потоке) пишет снимок и удаляет .old.
+    """
+
+    def __init__(self, path: str, journal_path: str):
+        self.path         = path
+        self.journal_path = journal_path
+        self.old_path     = journal_path + ".old"   # журнал, сворачиваемый прямо сейчас
+        self.records      = 0   # записей в журнале с момента снимка
+        self._journal     = None
+
+    def load(self) -> Dict[str, Any]:
+        data = default_db()
+        if os.path.exists(self.path):
+            # Повреждённый снимок — не повод молча начинать с пустой базы
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for k, v in default_db().items():
+                data.setdefault(k, v)
+        # .old остаётся, если процесс упал посреди свёртки; его записи
+        # идемпотентны и старше текущего журнала
+        self.records = self._replay(data, self.old_path) + self._replay(data, self.journal_path)
         return data
-    except Exception:
-        return default
 
+    @staticmethod
+    def _replay(data: Dict[str, Any], path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        count, good = 0, 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break   # нет перевода строки — запись недописана, даже если JSON целый
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break   # недописанная строка — процесс упал посреди записи
+                apply_record(data, rec)
+                count += 1
+                good  += len(line)
+        if good != os.path.getsize(path):
+            # Отрезаем хвост, чтобы новые записи не склеились с обрывком
+            os.truncate(path, good)
+        return count
+
+    def size(self) -> int:
+        return sum(os.path.getsize(p) for p in (self.path, self.old_path, self.journal_path)
+                   if os.path.exists(p))
+
+    def write(self, recs: List[Dict[str, Any]]) -> int:
+        """Дописывает записи в журнал; возвращает число записанных байт."""
+        lines = "".join(
+            json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in recs
+        ).encode("utf-8")
+        if self._journal is None:
+            self._journal = open(self.journal_path, "ab")
+        self._journal.write(lines)
+        self._journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self._journal.fileno())
+        self.records += len(recs)
+        return len(lines)
+
+    def rotate(self) -> None:
+        """
+        Начало свёртки: текущий журнал уходит в .old (его записи уже
+        учтены в базе, снимок которой сейчас будет записан), новые
+        записи пишутся в чистый журнал.
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_path):
+            if os.path.exists(self.old_path):
+                # Прошлая свёртка не дописала снимок — копим записи в .old
+                with open(self.old_path, "ab") as dst, open(self.journal_path, "rb") as src:
+                    shutil.copyfileobj(src, dst)
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.old_path)
+        self.records = 0
+
+    def write_snapshot(self, snap: Dict[str, Any]) -> int:
+        """
+        Снимок (результат snapshot_db) пишется атомарно: временный файл
+        + os.replace, .old удаляется только после. Записи идемпотентны,
+        так что падение между этими шагами безопасно. Резидентную базу
+        не трогает, поэтому может идти в отдельном потоке: чистый Python
+        json.dump регулярно отпускает GIL. Возвращает размер снимка.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(snap, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+        return os.path.getsize(self.path)
+
+    def compact(self, data: Dict[str, Any]) -> int:
+        """Свёртка целиком в текущем потоке (остановка бота)."""
+        snap = snapshot_db(data)
+        self.rotate()
+        return self.write_snapshot(snap)
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+class SqliteStorage:
+    """
+    SQLite-хранилище: игроки, матчи и санкции в отдельных таблицах
+    с индексами по external_id, elo и сроку санкции. Режим WAL —
+    чтение не блокирует запись. Прочие коллекции лежат в entities,
+    скалярные ключи и очереди — в meta.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS players (
+            user_id     INTEGER PRIMARY KEY,
+            external_id TEXT,
+            elo         INTEGER,
+            is_bot      INTEGER,
+            data        TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS players_external_id ON players(external_id);
+        CREATE INDEX IF NOT EXISTS players_elo         ON players(elo);
+
+        CREATE TABLE IF NOT EXISTS matches (
+            match_id TEXT PRIMARY KEY,
+            data     TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS sanctions (
+            kind    TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            until   REAL NOT NULL,
+            PRIMARY KEY (kind, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS sanctions_until ON sanctions(until);
+
+        CREATE TABLE IF NOT EXISTS entities (
+            coll TEXT NOT NULL,
+            key  TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (coll, key)
+        );
+
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path    = path
+        self.records = 0   # записей с последнего чекпойнта WAL
+        self.conn    = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def load(self) -> Dict[str, Any]:
+        data = default_db()
+        cur  = self.conn
+        for uid, raw in cur.execute("SELECT user_id, data FROM players"):
+            data["players"][str(uid)] = json.loads(raw)
+        for m_id, raw in cur.execute("SELECT match_id, data FROM matches"):
+            data["active_matches"][m_id] = json.loads(raw)
+        for kind, uid, until in cur.execute("SELECT kind, user_id, until FROM sanctions"):
+            data[kind][uid] = until
+        for coll, key, raw in cur.execute("SELECT coll, key, data FROM entities"):
+            data.setdefault(coll, {})[key] = json.loads(raw)
+        for key, raw in cur.execute("SELECT key, value FROM meta"):
+            data[key] = json.loads(raw)
+        return data
+
+    def _exec(self, rec: Dict[str, Any]) -> None:
+        op, cur = rec["op"], self.conn
+        if op == "set":
+            cur.execute(
+                "INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)",
+                (rec["k"], json.dumps(rec["v"], ensure_ascii=False))
+            )
+            return
+        coll, key = rec["c"], rec["k"]
+        if coll == "players":
+            if op == "put":
+                v = rec["v"]
+                cur.execute(
+                    "INSERT OR REPLACE INTO players(user_id, external_id, elo, is_bot, data) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (int(key), v.get("external_id") or None, v.get("elo", ELO_START),
+                     int(bool(v.get("is_bot"))), json.dumps(v, ensure_ascii=False))
+                )
+            else:
+                cur.execute("DELETE FROM players WHERE user_id = ?", (int(key),))
+        elif coll == "active_matches":
+            if op == "put":
+                cur.execute(
+                    "INSERT OR REPLACE INTO matches(match_id, data) VALUES (?, ?)",
+                    (key, json.dumps(rec["v"], ensure_ascii=False))
+                )
+            else:
+                cur.execute("DELETE FROM matches WHERE match_id = ?", (key,))
+        elif coll in ("muted", "banned"):
+            if op == "put":
+                cur.execute(
+                    "INSERT OR REPLACE INTO sanctions(kind, user_id, until) VALUES (?, ?, ?)",
+                    (coll, key, rec["v"])
+                )
+            else:
+                cur.execute("DELETE FROM sanctions WHERE kind = ? AND user_id = ?", (coll, key))
+        else:
+            if op == "put":
+                cur.execute(
+                    "INSERT OR REPLACE INTO entities(coll, key, data) VALUES (?, ?, ?)",
+                    (coll, key, json.dumps(rec["v"], ensure_ascii=False))
+                )
+            else:
+                cur.execute("DELETE FROM entities WHERE coll = ? AND key = ?", (coll, key))
+
+    def size(self) -> int:
+        return sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+
+    def _wal_size(self) -> int:
+        try:
+            return os.path.getsize(self.path + "-wal")
+        except OSError:
+            return 0
+
+    def write(self, recs: List[Dict[str, Any]]) -> int:
+        """Пишет записи одной транзакцией; возвращает, на сколько байт вырос WAL."""
+        before = self._wal_size()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for r in recs:
+                self._exec(r)
+        self.records += len(recs)
+        return max(0, self._wal_size() - before)
+
+    def rewrite(self, data: Dict[str, Any]) -> None:
+        """Полностью заменяет содержимое таблиц текущей базой."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for table in ("players", "matches", "sanctions", "entities", "meta"):
+                self.conn.execute(f"DELETE FROM {table}")
+            for r in dump_records(data):
+                self._exec(r)
+
+    def compact(self, data: Dict[str, Any]) -> int:
+        """Чекпойнт WAL в основной файл; возвращает объём перенесённого WAL."""
+        moved = self._wal_size()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.records = 0
+        return moved
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def make_storage(kind: str):
+    if kind == "sqlite":
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage(DATA_FILE, JOURNAL_FILE)
+
+
+def migrate_json_to_sqlite() -> int:
+    """Разовый перенос faceit_db.json (+ журнал) в SQLite. Возвращает число записей."""
+    data = JsonStorage(DATA_FILE, JOURNAL_FILE).load()
+    dst  = SqliteStorage(SQLITE_FILE)
+    dst.rewrite(data)
+    dst.compact(data)
+    dst.close()
+    return len(dump_records(data))
+
+
+class StateStore:
+    """
+    Резидентное состояние бота поверх подключаемого хранилища
+    (JsonStorage или SqliteStorage). База читается один раз при старте,
+    все чтения идут из памяти, изменения уходят в хранилище маленькими
+    записями, а фоновый компактор периодически их сворачивает.
+    """
+
+    def __init__(self, backend: str, compact_interval: float, max_records: int):
+        self.backend_kind     = backend
+        self.compact_interval = compact_interval
+        self.max_records      = max_records
+        self.storage          = None
+        self.data: Optional[Dict[str, Any]] = None
+        self.dirty            = False   # нужна свёртка без новых записей
+        self.indexes: Dict[str, List[Any]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task]    = None
+        self._pending: Optional[asyncio.Future] = None   # снимок, который пишется в потоке
+
+    def load(self) -> Dict[str, Any]:
+        if self.storage is None:
+            self.storage = make_storage(self.backend_kind)
+        self.data  = decode_db(self.storage.load())
+        self.dirty = False
+        METRICS.inc("faceit_db_loads_total")
+        METRICS.inc("faceit_db_load_bytes_total", self.storage.size())
+        self._rebuild_indexes()
+        return self.data
+
+    def add_index(self, coll: str, index) -> None:
+        """
+        Подключает вторичный индекс к коллекции или ключу верхнего уровня.
+        Индекс должен уметь rebuild(items) и update(key, value)
+        (value=None — запись удалена; для ключа верхнего уровня value —
+        его новое значение целиком).
+        """
+        self.indexes.setdefault(coll, []).append(index)
+        if self.data is not None:
+            index.rebuild(self.data.get(coll, {}))
+
+    def _rebuild_indexes(self) -> None:
+        for coll, idxs in self.indexes.items():
+            for idx in idxs:
+                idx.rebuild(self.data.get(coll, {}))
+
+    def _record(self, change) -> Dict[str, Any]:
+        if isinstance(change, tuple):
+            coll, key = change[0], str(change[1])
+            if key in self.data.get(coll, {}):
+                return {"op": "put", "c": coll, "k": key, "v": to_storage(self.data[coll][key])}
+            return {"op": "del", "c": coll, "k": key}
+        return {"op": "set", "k": change, "v": self.data.get(change)}
+
+    def commit(self, changes) -> None:
+        """
+        Отправляет изменённые сущности в хранилище.
+        change — либо ключ верхнего уровня ("queue_5v5"),
+        либо пара (коллекция, ключ): ("players", uid).
+        Пустой набор — вся база будет записана при ближайшей свёртке.
+        """
+        if not changes:
+            self.dirty = True
+            self._rebuild_indexes()
+            return
+        t0      = time.perf_counter()
+        written = self.storage.write([self._record(c) for c in changes])
+        METRICS.histogram("faceit_db_write_seconds").observe(time.perf_counter() - t0)
+        METRICS.inc("faceit_db_writes_total")
+        METRICS.inc("faceit_db_records_total", len(changes))
+        METRICS.inc("faceit_db_write_bytes_total", written)
+        for c in changes:
+            if isinstance(c, tuple) and c[0] in self.indexes:
+                key = str(c[1])
+                val = self.data[c[0]].get(key)
+                for idx in self.indexes[c[0]]:
+                    idx.update(key, val)
+            elif c in self.indexes:
+                for idx in self.indexes[c]:
+                    idx.update(c, self.data.get(c))
+        if self.storage.records >= self.max_records and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _needs_compact(self) -> bool:
+        return self.data is not None and (self.dirty or self.storage.records > 0)
+
+    def compact(self) -> None:
+        if not self._needs_compact():
+            return
+        if self.dirty and isinstance(self.storage, SqliteStorage):
+            self.storage.rewrite(self.data)
+        METRICS.inc("faceit_db_compact_bytes_total", self.storage.compact(self.data))
+        METRICS.inc("faceit_db_compactions_total")
+        self.dirty = False
+
+    async def compact_async(self) -> None:
+        """
+        Фоновая свёртка. Для JSON в цикле событий делаются только копия
+        базы и смена журнала, сериализация и fsync снимка — в потоке.
+        """
+        if not isinstance(self.storage, JsonStorage):
+            self.compact()
+            return
+        if not self._needs_compact():
+            return
+        storage = self.storage
+        snap    = snapshot_db(self.data)
+        storage.rotate()
+        self.dirty    = False
+        self._pending = asyncio.ensure_future(asyncio.to_thread(storage.write_snapshot, snap))
+        # shield: остановка бота отменяет цикл, но дожидается записи снимка в stop()
+        try:
+            size = await asyncio.shield(self._pending)
+        except Exception:
+            self._pending = None
+            self.dirty    = True   # .old остался — следующая свёртка перепишет снимок
+            raise
+        self._pending = None
+        METRICS.inc("faceit_db_compact_bytes_total", size)
+        METRICS.inc("faceit_db_compactions_total")
+
+    async def _compact_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.compact_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.compact_async()
+            except Exception as e:
+                print(f"⚠️ Не удалось свернуть журнал: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task   = asyncio.get_running_loop().create_task(self._compact_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending is not None:
+            try:
+                await self._pending
+            except Exception as e:
+                print(f"⚠️ Не удалось записать снимок базы: {e}")
+            self._pending = None
+        if self.storage is not None:
+            self.compact()
+            self.storage.close()
+            self.storage = None
 
-def save_db(db: Dict[str, Any]) -> None:
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(db, f, indent=4, ensure_ascii=False)
+
+STATE = StateStore(DB_BACKEND, DB_COMPACT_INTERVAL, JOURNAL_MAX_RECORDS)
+
+
+def load_db() -> Dict[str, Any]:
+    """Возвращает резидентную базу (хранилище читается только при первом вызове)."""
+    if STATE.data is None:
+        STATE.load()
+    return STATE.data
+
+
+def save_db(db: Dict[str, Any], *changes) -> None:
+    """
+    Фиксирует изменения в хранилище:
+        save_db(db, "queue_5v5", ("active_matches", m_id))
+    Без аргументов — база целиком попадёт в ближайшую свёртку.
+    """
+    STATE.commit(changes)
 
 
 def get_player(uid: int, name: str = "Player") -> Player:
-    db = load_db()
-    s  = str(uid)
-    if s not in db["players"]:
-        db["players"][s] = asdict(Player(uid, name))
-        save_db(db)
-    d = db["players"][s]
-    for field, val in [("wins",0),("losses",0),("avg",0.0),
-                       ("elo",1000),("external_id",""),("is_bot",False)]:
-        d.setdefault(field, val)
-    return Player(**d)
+    """
+    Только чтение: для неизвестного uid возвращает временного игрока
+    по умолчанию, ничего не сохраняя. Записи в базе создаются лишь
+    регистрацией (/reg) и подведением итогов матча (/win).
+    Известный игрок возвращается резидентным объектом — менять его
+    можно только вместе с save_db.
+    """
+    p = load_db()["players"].get(str(uid))
+    return p if p is not None else Player(uid, name)
+
+
+def get_players(uids: List[int]) -> Dict[int, Player]:
+    """
+    Пакетный get_player: все игроки берутся из одного снимка базы.
+    Для рендера лобби, пиков и т.п. Ничего не записывает.
+    """
+    players = load_db()["players"]
+    out: Dict[int, Player] = {}
+    for uid in uids:
+        p = players.get(str(uid))
+        out[uid] = p if p is not None else Player(uid, "Player")
+    return out
+
+
+def team_list(uids: List[int]) -> str:
+    """Список состава команды — по строке на игрока."""
+    ps = get_players(uids)
+    return "\n".join(
+        f"  • {ps[u].tg_link()} <code>[{ps[u].external_id or '?'}]</code>" for u in uids
+    )
+
+# ════════════════════════════════════════════════
+#                   ИНДЕКСЫ
+# ════════════════════════════════════════════════
+
+class Leaderboard:
+    """
+    Рейтинг, поддерживаемый инкрементально: отсортированный список
+    ключей (-elo, uid). В рейтинг попадают только зарегистрированные
+    живые игроки. Обновляется при каждом сохранении записи игрока,
+    так что /top, /elo и /rank не сортируют всю базу заново.
+    """
+
+    def __init__(self):
+        self._keys: List[Tuple[int, int]] = []
+        self._elo:  Dict[int, int]        = {}
+
+    @staticmethod
+    def _eligible(p: Optional[Player]) -> bool:
+        return bool(p and p.external_id and not p.is_bot)
+
+    def rebuild(self, players: Dict[str, Player]) -> None:
+        self._elo  = {int(s): p.elo for s, p in players.items() if self._eligible(p)}
+        self._keys = sorted((-elo, uid) for uid, elo in self._elo.items())
+
+    def update(self, key: str, p: Optional[Player]) -> None:
+        uid = int(key)
+        old = self._elo.pop(uid, None)
+        if old is not None:
+            del self._keys[bisect_left(self._keys, (-old, uid))]
+        if self._eligible(p):
+            elo = p.elo
+            self._elo[uid] = elo
+            insort(self._keys, (-elo, uid))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def top(self, k: int, offset: int = 0) -> List[int]:
+        return [uid for _, uid in self._keys[offset:offset + k]]
+
+    def rank(self, uid: int) -> Optional[int]:
+        """Место игрока в рейтинге (с 1) или None, если его там нет."""
+        elo = self._elo.get(uid)
+        if elo is None:
+            return None
+        return bisect_left(self._keys, (-elo, uid)) + 1
+
+
+class ExternalIdIndex:
+    """
+    Вторичный индекс FACEIT ID → user_id по живым игрокам.
+    Проверка уникальности в /reg и поиск /faceit — O(1).
+    """
+
+    def __init__(self):
+        self._by_eid: Dict[str, int] = {}
+        self._by_uid: Dict[int, str] = {}
+
+    def rebuild(self, players: Dict[str, Player]) -> None:
+        self._by_eid, self._by_uid = {}, {}
+        for s, p in players.items():
+            self.update(s, p)
+
+    def update(self, key: str, p: Optional[Player]) -> None:
+        uid = int(key)
+        old = self._by_uid.pop(uid, None)
+        if old is not None and self._by_eid.get(old) == uid:
+            del self._by_eid[old]
+        if p and p.external_id and not p.is_bot:
+            eid = p.external_id
+            self._by_uid[uid] = eid
+            self._by_eid.setdefault(eid, uid)
+
+    def get(self, external_id: str) -> Optional[int]:
+        return self._by_eid.get(external_id)
+
+
+class SanctionCache:
+    """
+    Кэш мутов или банов: uid → срок окончания плюс min-heap по сроку.
+    Проверка активности — O(1), истёкшие записи достаются из кучи
+    фоновой чисткой (sweep_sanctions). Устаревшие элементы кучи
+    (санкцию сняли или продлили) пропускаются лениво.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._until: Dict[int, float]          = {}
+        self._heap:  List[Tuple[float, int]]   = []
+        self.on_expire: List[Any]              = []   # async hook(bot, uid)
+
+    def rebuild(self, items: Dict[str, Any]) -> None:
+        self._until = {int(s): until for s, until in items.items() if until}
+        self._heap  = [(until, uid) for uid, until in self._until.items()]
+        heapq.heapify(self._heap)
+
+    def update(self, key: str, until: Optional[float]) -> None:
+        uid = int(key)
+        if until:
+            self._until[uid] = until
+            heapq.heappush(self._heap, (until, uid))
+        else:
+            self._until.pop(uid, None)
+
+    def active(self, uid: int, now: Optional[float] = None) -> bool:
+        until = self._until.get(uid)
+        if until is None:
+            return False
+        return (now or datetime.now().timestamp()) < until
+
+    def pop_expired(self, now: float) -> List[int]:
+        out = []
+        while self._heap and self._heap[0][0] <= now:
+            until, uid = heapq.heappop(self._heap)
+            if self._until.get(uid) == until:
+                out.append(uid)
+        return out
+
+
+class MatchmakingQueue:
+    """
+    Индекс очереди queue_<mode> по ELO для подбора лобби.
+
+    Держит игроков очереди отсортированными по рейтингу (на момент входа)
+    и помнит, когда и из какого чата каждый встал в очередь (копия
+    db["queue_joins"], переживает перезапуск). find_lobby()
+    проходит скользящим окном размера лобби по отсортированному списку —
+    O(n·size) даже для сотен игроков в очереди.
+    """
+
+    def __init__(self, mode: str, size: int):
+        self.mode      = mode
+        self.size      = size
+        self._sorted:  List[Tuple[int, int]] = []   # (elo, uid)
+        self._elo:     Dict[int, int]        = {}
+        self.joined:   Dict[int, float]      = {}
+        self.chat:     Dict[int, int]        = {}
+        self.last_chat: Optional[int]        = None
+
+    def rebuild(self, queue: List[int]) -> None:
+        self._sorted, self._elo = [], {}
+        queued = set(queue)
+        for s, j in load_db().get("queue_joins", {}).items():
+            if j.get("mode") == self.mode and int(s) in queued:
+                self.joined.setdefault(int(s), j["ts"])
+                self.chat.setdefault(int(s), j["chat"])
+        self.update(f"queue_{self.mode}", queue)
+
+    def update(self, key: str, queue: Optional[List[int]]) -> None:
+        # joined/chat вышедших из очереди не забываются: игрок отменённого
+        # матча возвращается в очередь со своим прежним временем ожидания,
+        # а новый вход (note_join) всё равно перезаписывает оба значения
+        members = set(queue or [])
+        for uid in [u for u in self._elo if u not in members]:
+            elo = self._elo.pop(uid)
+            del self._sorted[bisect_left(self._sorted, (elo, uid))]
+        players = load_db()["players"]
+        now     = time.time()
+        for uid in queue or []:
+            if uid not in self._elo:
+                p   = players.get(str(uid))
+                elo = p.elo if p is not None else ELO_START
+                self._elo[uid] = elo
+                insort(self._sorted, (elo, uid))
+                self.joined.setdefault(uid, now)
+
+    def note_join(self, uid: int, chat_id: int) -> Dict[str, Any]:
+        """Запоминает вход в очередь; возвращает запись для db["queue_joins"]."""
+        self.joined[uid] = time.time()
+        self.chat[uid]   = chat_id
+        self.last_chat   = chat_id
+        return {"mode": self.mode, "chat": chat_id, "ts": self.joined[uid]}
+
+    def tolerance(self, uid: int, now: float) -> float:
+        wait = now - self.joined.get(uid, now)
+        if wait >= MM_MAX_WAIT:
+            return float("inf")
+        return MM_BASE_SPREAD + MM_SPREAD_PER_SEC * wait
+
+    def find_lobby(self, now: Optional[float] = None) -> Optional[List[int]]:
+        """
+        Лучшее лобби: окно из size соседних по ELO игроков с наименьшим
+        разбросом, укладывающимся в допуск самого давнего игрока окна.
+        При равенстве — окно, где ждут дольше. None — собрать пока нельзя.
+        """
+        k = self.size
+        if len(self._sorted) < k:
+            return None
+        now  = now or time.time()
+        best = None
+        for i in range(len(self._sorted) - k + 1):
+            window = self._sorted[i:i + k]
+            spread = window[-1][0] - window[0][0]
+            oldest = min(window, key=lambda e: self.joined.get(e[1], now))[1]
+            if spread > self.tolerance(oldest, now):
+                continue
+            rank = (spread, self.joined.get(oldest, now))
+            if best is None or rank < best[0]:
+                best = (rank, [uid for _, uid in window])
+        return best[1] if best else None
+
+    def chat_for(self, lobby: List[int]) -> Optional[int]:
+        """
+        Чат для объявления матча — тот, где встал в очередь самый давний
+        игрок. Если о нём ничего не известно — последний чат входа или
+        любой чат с открытым лобби этого режима.
+        """
+        oldest = min(lobby, key=lambda u: self.joined.get(u, float("inf")))
+        chat   = self.chat.get(oldest, self.last_chat)
+        if chat is None:
+            chat = next((l["chat_id"] for l in load_db().get("lobbies", {}).values()
+                         if l["mode"] == self.mode), None)
+        return chat
+
+
+class VersionCounter:
+    """Номер версии коллекции: растёт при каждом сохранённом изменении."""
+
+    def __init__(self):
+        self.version = 0
+
+    def rebuild(self, items) -> None:
+        self.version += 1
+
+    def update(self, key: str, value) -> None:
+        self.version += 1
+
+
+class RenderCache:
+    """
+    LRU-кэш готовых текстов и клавиатур. В ключ входят номера версий
+    состояния, из которого строится рендер, так что любое сохранённое
+    изменение само делает старые записи недостижимыми, а LRU их вытесняет.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self.hits   = 0
+        self.misses = 0
+
+    def get(self, key: Tuple, render):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            value = self._data[key] = render()
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return value
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+
+LEADERBOARD  = Leaderboard()
+EXTERNAL_IDS = ExternalIdIndex()
+MUTES        = SanctionCache("muted")
+BANS         = SanctionCache("banned")
+STATE.add_index("players", LEADERBOARD)
+STATE.add_index("players", EXTERNAL_IDS)
+STATE.add_index("muted",   MUTES)
+STATE.add_index("banned",  BANS)
+
+# Версия игроков: от неё зависят ники, ELO и иконки во всех рендерах
+PLAYERS_VERSION = VersionCounter()
+RENDER_CACHE    = RenderCache(RENDER_CACHE_SIZE)
+STATE.add_index("players", PLAYERS_VERSION)
+
+MATCHMAKERS = {
+    "5v5": MatchmakingQueue("5v5", LOBBY_5V5_SIZE),
+    "2v2": MatchmakingQueue("2v2", LOBBY_2V2_SIZE),
+}
+for _mode, _mm in MATCHMAKERS.items():
+    STATE.add_index(f"queue_{_mode}", _mm)
+
+# ════════════════════════════════════════════════
+#                 БЛОКИРОВКИ
+# ════════════════════════════════════════════════
+#
+# Апдейты могут обрабатываться параллельно, а обработчики делают
+# load → изменить → save с await-ами посередине. Каждый матч и каждая
+# очередь защищены своим asyncio.Lock, поэтому независимые матчи идут
+# параллельно, а клики внутри одного матча — строго по очереди.
+# Лок живёт, пока его кто-то держит или ждёт (WeakValueDictionary).
+
+_LOCKS: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _lock(key: str) -> asyncio.Lock:
+    lock = _LOCKS.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _LOCKS[key] = lock
+    return lock
+
+
+def match_lock(m_id: str) -> asyncio.Lock:
+    return _lock(f"match:{m_id}")
+
+
+def queue_lock(mode: str) -> asyncio.Lock:
+    """Лок очереди; если нужны обе — брать в порядке "2v2", "5v5"."""
+    return _lock(f"queue:{mode}")
+
+
+def match_cas(db: Dict[str, Any], m_id: str, rev: int) -> Optional[Match]:
+    """
+    Compare-and-swap для состояния матча: возвращает матч, только если
+    его ревизия всё ещё rev, то есть с момента чтения никто не походил.
+    """
+    m = db["active_matches"].get(m_id)
+    if m is None or m.rev != rev:
+        return None
+    return m
+
+
+def commit_match(db: Dict[str, Any], m_id: str) -> None:
+    """Сохраняет матч, увеличивая его ревизию (или фиксирует удаление)."""
+    m = db["active_matches"].get(m_id)
+    if m is not None:
+        m.rev += 1
+    save_db(db, ("active_matches", m_id))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обработчик апдейтов для concurrent_updates: не больше workers
+    обработчиков одновременно, при этом апдейты одного чата идут строго
+    в порядке поступления. Очередь чата берётся до слота воркера, так что
+    всплеск в одном чате не занимает воркеры, нужные другим чатам.
+    """
+
+    def __init__(self, workers: int, backlog: int):
+        super().__init__(workers + backlog)
+        self._workers  = asyncio.BoundedSemaphore(workers)
+        self.in_flight = 0
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        self.in_flight += 1
+        try:
+            chat = getattr(update, "effective_chat", None)
+            if chat is None:
+                async with self._workers:
+                    await coroutine
+                return
+            async with _lock(f"chat:{chat.id}"):
+                async with self._workers:
+                    await coroutine
+        finally:
+            self.in_flight -= 1
+
+    # Начатые апдейты дорабатывает сам Application.stop() — он ждёт
+    # update_queue.join(), так что к shutdown() ждать уже нечего.
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ════════════════════════════════════════════════
+#                    РЕЙТИНГ
+# ════════════════════════════════════════════════
+
+GLICKO_SCALE = 173.7178
+
+
+class RatingModel:
+    """
+    Модель рейтинга. rate() получает игроков обеих команд
+    (объекты Player из db["players"]), меняет у живых игроков elo (и, если модели
+    нужно, rd/vol) и возвращает изменения ELO по uid. Боты участвуют
+    в расчёте силы команды, но их рейтинг не меняется.
+    """
+
+    name = ""
+
+    def rate(self, winners: List[Player], losers: List[Player]) -> Dict[str, int]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _apply(p: Player, new_elo: float, deltas: Dict[str, int]) -> None:
+        new = max(ELO_MIN, int(round(new_elo)))
+        deltas[str(p.user_id)] = new - p.elo
+        p.elo = new
+
+
+class FlatRating(RatingModel):
+    """Прежняя схема: +ELO_WIN победителям, -ELO_LOSS проигравшим."""
+
+    name = "flat"
+
+    def rate(self, winners, losers):
+        deltas: Dict[str, int] = {}
+        for p in winners:
+            if not p.is_bot:
+                self._apply(p, p.elo + ELO_WIN, deltas)
+        for p in losers:
+            if not p.is_bot:
+                self._apply(p, p.elo - ELO_LOSS, deltas)
+        return deltas
+
+
+class EloRating(RatingModel):
+    """
+    Классический Elo по средним рейтингам команд. Ожидаемый результат
+    считается один на команду, а K — у каждого игрока свой: новичкам
+    (меньше ELO_PROVISIONAL_GAMES матчей) рейтинг двигается быстрее.
+    """
+
+    name = "elo"
+
+    @staticmethod
+    def k_factor(p: Player) -> float:
+        games = p.wins + p.losses
+        return ELO_K_PROVISIONAL if games < ELO_PROVISIONAL_GAMES else ELO_K
+
+    def rate(self, winners, losers):
+        avg_w    = sum(p.elo for p in winners) / len(winners)
+        avg_l    = sum(p.elo for p in losers) / len(losers)
+        expected = 1 / (1 + 10 ** ((avg_l - avg_w) / 400))
+        deltas: Dict[str, int] = {}
+        for team, score in ((winners, 1.0), (losers, 0.0)):
+            exp = expected if score else 1 - expected
+            for p in team:
+                if not p.is_bot:
+                    self._apply(p, p.elo + self.k_factor(p) * (score - exp), deltas)
+        return deltas
+
+
+class Glicko2Rating(RatingModel):
+    """
+    Glicko-2 (Glickman, 2012): у игрока кроме рейтинга есть отклонение rd
+    и волатильность vol. Соперник для каждого игрока — «составной» игрок
+    со средним рейтингом команды противника и её среднеквадратичным rd.
+    Каждый матч считается отдельным рейтинговым периодом.
+    """
+
+    name = "glicko2"
+
+    @staticmethod
+    def _g(phi: float) -> float:
+        return 1 / math.sqrt(1 + 3 * phi * phi / (math.pi * math.pi))
+
+    def _volatility(self, phi: float, sigma: float, v: float, delta: float) -> float:
+        a   = math.log(sigma * sigma)
+        tau = GLICKO_TAU
+
+        def f(x: float) -> float:
+            ex = math.exp(x)
+            return (ex * (delta * delta - phi * phi - v - ex)
+                    / (2 * (phi * phi + v + ex) ** 2)) - (x - a) / (tau * tau)
+
+        A = a
+        if delta * delta > phi * phi + v:
+            B = math.log(delta * delta - phi * phi - v)
+        else:
+            k = 1
+            while f(a - k * tau) < 0:
+                k += 1
+            B = a - k * tau
+        fA, fB = f(A), f(B)
+        while abs(B - A) > 1e-6:
+            C  = A + (A - B) * fA / (fB - fA)
+            fC = f(C)
+            if fC * fB <= 0:
+                A, fA = B, fB
+            else:
+                fA /= 2
+            B, fB = C, fC
+        return math.exp(A / 2)
+
+    def _update(self, p: Player, opp_elo: float, opp_rd: float, score: float) -> float:
+        mu    = (p.elo - ELO_START) / GLICKO_SCALE
+        phi   = p.rd / GLICKO_SCALE
+        sigma = p.vol
+        mu_j  = (opp_elo - ELO_START) / GLICKO_SCALE
+        g     = self._g(opp_rd / GLICKO_SCALE)
+        e     = 1 / (1 + math.exp(-g * (mu - mu_j)))
+        v     = 1 / (g * g * e * (1 - e))
+        delta = v * g * (score - e)
+
+        sigma   = self._volatility(phi, sigma, v, delta)
+        phi_pre = math.sqrt(phi * phi + sigma * sigma)
+        phi     = 1 / math.sqrt(1 / (phi_pre * phi_pre) + 1 / v)
+        mu      = mu + phi * phi * g * (score - e)
+
+        p.rd  = round(min(GLICKO_RD, max(GLICKO_RD_MIN, phi * GLICKO_SCALE)), 2)
+        p.vol = round(sigma, 6)
+        return mu * GLICKO_SCALE + ELO_START
+
+    def rate(self, winners, losers):
+        def composite(team):
+            elo = sum(p.elo for p in team) / len(team)
+            rd  = math.sqrt(sum(p.rd ** 2 for p in team) / len(team))
+            return elo, rd
+
+        w_elo, w_rd = composite(winners)
+        l_elo, l_rd = composite(losers)
+        deltas: Dict[str, int] = {}
+        for team, (o_elo, o_rd), score in ((winners, (l_elo, l_rd), 1.0),
+                                           (losers,  (w_elo, w_rd), 0.0)):
+            for p in team:
+                if not p.is_bot:
+                    self._apply(p, self._update(p, o_elo, o_rd, score), deltas)
+        return deltas
+
+
+RATING_MODELS: Dict[str, RatingModel] = {
+    m.name: m for m in (FlatRating(), EloRating(), Glicko2Rating())
+}
+
+
+def rating_model(db: Dict) -> RatingModel:
+    """Текущая модель: выбор админа из базы или RATING_MODEL по умолчанию."""
+    name = db.get("settings", {}).get("rating_model", RATING_MODEL)
+    return RATING_MODELS.get(name, RATING_MODELS[RATING_MODEL])
+
+
+def recompute_ratings(players: Dict[str, Player], model: RatingModel) -> Tuple[int, Dict[str, Player]]:
+    """
+    Пересчитывает рейтинги игроков, проигрывая журнал матчей по порядку.
+    Журнал ведётся не с первого матча, поэтому каждый игрок стартует
+    с рейтинга перед своим первым матчем в журнале (e - d этой записи;
+    если их там нет — с текущего рейтинга), а матчи до журнала
+    (wins + losses сверх записанных) идут в счёт K-фактора Elo.
+    База не трогается: players — копия игроков, рейтинги копятся
+    в рабочих объектах, так что пересчёт можно гонять в потоке.
+    Возвращает (число матчей, рабочие объекты по uid) — в базу их
+    переносит apply_ratings().
+    """
+    first:  Dict[str, Optional[int]] = {}   # рейтинг перед первым матчем в журнале
+    logged: Dict[str, List[int]]     = {}   # [побед, поражений] в журнале
+    for entry in iter_match_log():
+        if not entry["w"] or not entry["l"]:
+            continue
+        d, e = entry.get("d") or {}, entry.get("e") or {}
+        for i, team in enumerate((entry["w"], entry["l"])):
+            for u in team:
+                s = str(u)
+                logged.setdefault(s, [0, 0])[i] += 1
+                if s not in first:
+                    first[s] = e[s] - d[s] if s in d and s in e else None
+
+    work: Dict[str, Player] = {}
+
+    def state(uid: int) -> Player:
+        s = str(uid)
+        if s not in work:
+            p   = players.get(s)
+            bot = p.is_bot if p is not None else _is_bot_uid(uid)
+            if p is None:
+                work[s] = Player(uid, "", is_bot=bot)
+            elif bot:
+                work[s] = Player(uid, "", elo=p.elo, is_bot=True)
+            else:
+                base = first.get(s)
+                w, l = logged.get(s, (0, 0))
+                work[s] = Player(uid, "", elo=p.elo if base is None else base,
+                                 wins=max(0, p.wins - w), losses=max(0, p.losses - l))
+        return work[s]
+
+    n = 0
+    for entry in iter_match_log():
+        winners = [state(u) for u in entry["w"]]
+        losers  = [state(u) for u in entry["l"]]
+        if not winners or not losers:
+            continue
+        model.rate(winners, losers)
+        for p in winners:
+            p.wins += 1
+        for p in losers:
+            p.losses += 1
+        n += 1
+    return n, work
+
+
+def apply_ratings(db: Dict, work: Dict[str, Player]) -> List[str]:
+    """Переносит рейтинги из recompute_ratings() в базу; возвращает uid изменённых."""
+    changed = []
+    for s, w in work.items():
+        p = db["players"].get(s)
+        if p is None or p.is_bot:
+            continue
+        p.elo, p.rd, p.vol = w.elo, w.rd, w.vol
+        changed.append(s)
+    return changed
+
+
+def match_log_size() -> int:
+    return os.path.getsize(MATCH_LOG_FILE) if os.path.exists(MATCH_LOG_FILE) else 0
+
+# ════════════════════════════════════════════════
+#                ЖУРНАЛ МАТЧЕЙ
+# ════════════════════════════════════════════════
+
+# Одна строка JSON на сыгранный матч, в порядке закрытия. Ключи короткие:
+#   {"id": "12", "mode": "5v5", "side": "ct",      ← сторона победителей
+#    "w": [...], "l": [...],                        ← победители / проигравшие
+#    "map": "Nuke", "bans": ["Dust2", ...],
+#    "d": {"123": 18, ...},                         ← изменение ELO по uid
+#    "e": {"123": 1118, ...},                       ← ELO после матча
+#    "ts": [создан, начало банов, карта выбрана, закрыт]}   ← unix-время, сек
+# Журнал только дописывается; старые записи (без map/bans/d/ts) читаются так же.
+
+HISTORY_CSV_HEADER = "id,mode,side,map,bans,winners,losers,elo_deltas,created,bans_start,live,closed\n"
+
+
+def history_entry(m_id: str, m: Match, side: str, deltas: Dict[str, int],
+                  ratings: Dict[str, int]) -> Dict[str, Any]:
+    winners = m.ct if side == "ct" else m.t
+    losers  = m.t  if side == "ct" else m.ct
+    ts = [m.pick_start_time, m.ban_start_time, m.live_time, time.time()]
+    return {
+        "id":   m_id,
+        "mode": m.mode,
+        "side": side,
+        "w":    winners,
+        "l":    losers,
+        "map":  m.maps[0] if len(m.maps) == 1 else None,
+        "bans": m.banned_maps,
+        "d":    deltas,
+        "e":    ratings,
+        "ts":   [int(t) if t else None for t in ts],
+    }
+
+
+def entry_times(e: Dict[str, Any]) -> List[Optional[int]]:
+    """[создан, начало банов, карта выбрана, закрыт]; в ранних записях было только время закрытия."""
+    ts = e.get("ts")
+    if not isinstance(ts, list):
+        return [None, None, None, ts]
+    return (ts + [None] * 4)[:4]
+
+
+def repair_match_log() -> None:
+    """Обрезает недописанную последнюю строку, чтобы следующая запись не склеилась с ней."""
+    if not os.path.exists(MATCH_LOG_FILE):
+        return
+    with open(MATCH_LOG_FILE, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if not size:
+            return
+        f.seek(max(0, size - 4096))
+        tail = f.read()
+    if tail.endswith(b"\n"):
+        return
+    cut = tail.rfind(b"\n")
+    os.truncate(MATCH_LOG_FILE, size - len(tail) + cut + 1 if cut >= 0 else max(0, size - len(tail)))
+
+
+def append_match_log(entry: Dict[str, Any]) -> None:
+    """Дописывает итог матча в конец журнала (по строке JSON на матч)."""
+    with open(MATCH_LOG_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        if JOURNAL_FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def iter_match_log(mode: Optional[str] = None, uid: Optional[int] = None):
+    """
+    Итоги матчей по порядку, без загрузки журнала целиком в память.
+    Можно отфильтровать по режиму и по участнику.
+    """
+    if not os.path.exists(MATCH_LOG_FILE):
+        return
+    with open(MATCH_LOG_FILE, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue   # недописанная строка после сбоя
+            if mode is not None and entry.get("mode", "5v5") != mode:
+                continue
+            if uid is not None and uid not in entry["w"] and uid not in entry["l"]:
+                continue
+            yield entry
+
+
+def export_history_csv(mode: Optional[str] = None, uid: Optional[int] = None):
+    """Потоковый экспорт журнала в CSV — по строке за раз, начиная с заголовка."""
+    yield HISTORY_CSV_HEADER
+    for e in iter_match_log(mode, uid):
+        ts = entry_times(e)
+        cols = [
+            e["id"], e.get("mode", "5v5"), e.get("side", ""), e.get("map") or "",
+            " ".join(e.get("bans", [])),
+            " ".join(map(str, e["w"])), " ".join(map(str, e["l"])),
+            " ".join(f"{u}:{d:+d}" for u, d in e.get("d", {}).items()),
+            *("" if t is None else str(t) for t in ts),
+        ]
+        yield ",".join(cols) + "\n"
+
+# ════════════════════════════════════════════════
+#                  СТАТИСТИКА
+# ════════════════════════════════════════════════
+
+class MatchStats:
+    """
+    Агрегаты по сыгранным матчам: у каждого игрока — счёт по картам и
+    сторонам, с кем и против кого он играл, и последние значения ELO;
+    по каждой карте — число матчей и побед CT. Счёт хранится парами
+    [побед, поражений]. Обновляется на каждом /win, при старте
+    собирается заново одним проходом по журналу матчей.
+    """
+
+    def __init__(self, series_len: int):
+        self.series_len = series_len
+        self.players: Dict[int, Dict[str, Any]] = {}
+        self.maps: Dict[str, List[int]] = {}   # карта → [матчей, побед CT]
+        self.matches = 0
+
+    def rebuild(self, entries) -> None:
+        self.players = {}
+        self.maps    = {}
+        self.matches = 0
+        for e in entries:
+            self.add(e)
+
+    def _player(self, uid: int) -> Dict[str, Any]:
+        st = self.players.get(uid)
+        if st is None:
+            st = self.players[uid] = {
+                "maps":  {},
+                "sides": {"ct": [0, 0], "t": [0, 0]},
+                "mates": {},
+                "opps":  {},
+                "elo":   deque(maxlen=self.series_len),   # (время, ELO после матча)
+            }
+        return st
+
+    def add(self, e: Dict[str, Any]) -> None:
+        side    = e.get("side")
+        map_    = e.get("map")
+        closed  = entry_times(e)[3]
+        ratings = e.get("e", {})
+        if map_:
+            m = self.maps.setdefault(map_, [0, 0])
+            m[0] += 1
+            if side == "ct":
+                m[1] += 1
+
+        for team, other, won in ((e["w"], e["l"], True), (e["l"], e["w"], False)):
+            i = 0 if won else 1
+            my_side = None
+            if side in ("ct", "t"):
+                my_side = side if won else ("t" if side == "ct" else "ct")
+            for uid in team:
+                if _is_bot_uid(uid):
+                    continue
+                st = self._player(uid)
+                if map_:
+                    st["maps"].setdefault(map_, [0, 0])[i] += 1
+                if my_side:
+                    st["sides"][my_side][i] += 1
+                for mate in team:
+                    if mate != uid and not _is_bot_uid(mate):
+                        st["mates"].setdefault(mate, [0, 0])[i] += 1
+                for opp in other:
+                    if not _is_bot_uid(opp):
+                        st["opps"].setdefault(opp, [0, 0])[i] += 1
+                elo = ratings.get(str(uid))
+                if elo is not None:
+                    st["elo"].append((closed, elo))
+        self.matches += 1
+
+    def get(self, uid: int) -> Optional[Dict[str, Any]]:
+        return self.players.get(uid)
+
+
+STATS = MatchStats(STATS_ELO_POINTS)
+
+
+def winrate(wl: List[int]) -> str:
+    total = wl[0] + wl[1]
+    return f"{wl[0] / total * 100:.0f}%" if total else "—"
+
+
+def sparkline(values: List[int]) -> str:
+    """Мини-график ряда значений символами ▁▂▃▄▅▆▇█."""
+    if not values:
+        return ""
+    bars   = "▁▂▃▄▅▆▇█"
+    lo, hi = min(values), max(values)
+    if hi == lo:
+        return bars[3] * len(values)
+    return "".join(bars[(v - lo) * (len(bars) - 1) // (hi - lo)] for v in values)
+
+# ════════════════════════════════════════════════
+#            РЕДАКТИРОВАНИЕ СООБЩЕНИЙ
+# ════════════════════════════════════════════════
+#
+# Когда десять человек одновременно жмут «Присоединиться», каждое
+# нажатие хочет перерисовать одно и то же сообщение лобби, и Telegram
+# отвечает flood control. Правки одного сообщения копятся EDIT_WINDOW
+# секунд, и уходит только последняя; отправка выдерживает паузы на
+# чат и на бота в целом, а RetryAfter переживается повтором.
+
+class EditCoalescer:
+
+    def __init__(self, window: float, chat_interval: float, global_rate: float):
+        self.window          = window
+        self.chat_interval   = chat_interval
+        self.global_interval = 1 / global_rate
+        self._pending: Dict[Tuple[int, int], Tuple[str, Any]] = {}
+        self._tasks:   Dict[Tuple[int, int], asyncio.Task]    = {}
+        self._sent:    "OrderedDict[Tuple[int, int], Tuple[str, Any]]" = OrderedDict()
+        self._chat_next: Dict[int, float] = {}
+        self._global_next = 0.0
+        self.edits   = 0   # ушло в Telegram
+        self.skipped = 0   # поглощено окном или совпало с уже показанным
+        self.on_gone: List[Any] = []   # вызываются с (chat_id, message_id), если сообщения больше нет
+
+    def submit(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None) -> None:
+        """Ставит правку в очередь; более поздняя правка того же сообщения заменяет раннюю."""
+        key = (chat_id, message_id)
+        if key in self._pending:
+            self.skipped += 1
+        self._pending[key] = (text, reply_markup)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.get_running_loop().create_task(self._flush(bot, key))
+
+    async def _throttle(self, chat_id: int) -> None:
+        # Слот бронируется синхронно, поэтому параллельные отправки не делят одну паузу
+        loop = asyncio.get_running_loop()
+        now  = loop.time()
+        at   = max(now, self._chat_next.get(chat_id, 0.0), self._global_next)
+        self._chat_next[chat_id] = at + self.chat_interval
+        self._global_next        = at + self.global_interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    async def _flush(self, bot, key: Tuple[int, int]) -> None:
+        chat_id, message_id = key
+        retries = 0
+        try:
+            await asyncio.sleep(self.window)
+            while key in self._pending:
+                await self._throttle(chat_id)
+                content = self._pending.pop(key)
+                if self._sent.get(key) == content:
+                    self.skipped += 1
+                    continue
+                text, markup = content
+                try:
+                    await bot.edit_message_text(
+                        text, chat_id=chat_id, message_id=message_id,
+                        reply_markup=markup, parse_mode=ParseMode.HTML
+                    )
+                except RetryAfter as e:
+                    if retries >= EDIT_MAX_RETRIES:
+                        continue
+                    retries += 1
+                    # Новая правка, пришедшая за время ожидания, важнее этой
+                    self._pending.setdefault(key, content)
+                    self._chat_next[chat_id] = asyncio.get_running_loop().time() + e.retry_after
+                    continue
+                except BadRequest as e:
+                    err = str(e).lower()
+                    if "not found" in err or "can't be edited" in err:
+                        for hook in self.on_gone:
+                            hook(chat_id, message_id)
+                    if "not modified" not in err:
+                        continue
+                except Exception:
+                    continue
+                retries = 0
+                self.edits += 1
+                self._sent[key] = content
+                self._sent.move_to_end(key)
+                if len(self._sent) > EDIT_SENT_CACHE:
+                    self._sent.popitem(last=False)
+        finally:
+            self._tasks.pop(key, None)
+
+    async def close(self, timeout: float = 0.0) -> None:
+        """Дожидается отложенных правок (не дольше timeout), остальные отменяет."""
+        tasks = list(self._tasks.values())
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        self._pending.clear()
+
+
+EDITS = EditCoalescer(EDIT_WINDOW, EDIT_CHAT_INTERVAL, EDIT_GLOBAL_RATE)
 
 # ════════════════════════════════════════════════
 #             ПРОВЕРКИ БАН / МУТ / РЕГ
 # ════════════════════════════════════════════════
 
 def check_banned(uid: int) -> bool:
-    db    = load_db()
-    until = db["banned"].get(str(uid))
-    return bool(until and datetime.now().timestamp() < until)
+    load_db()
+    return BANS.active(uid)
 
 
 def check_muted(uid: int) -> bool:
-    db    = load_db()
-    until = db["muted"].get(str(uid))
-    return bool(until and datetime.now().timestamp() < until)
+    load_db()
+    return MUTES.active(uid)
 
 
 def is_registered(uid: int) -> bool:
-    db = load_db()
-    s  = str(uid)
-    return s in db["players"] and bool(db["players"][s].get("external_id"))
+    p = load_db()["players"].get(str(uid))
+    return bool(p and p.external_id)
+
+
+async def sweep_sanctions(bot) -> None:
+    """Удаляет истёкшие муты/баны из базы и вызывает их on_expire-хуки."""
+    db  = load_db()
+    now = datetime.now().timestamp()
+    for cache in (MUTES, BANS):
+        for uid in cache.pop_expired(now):
+            db[cache.kind].pop(str(uid), None)
+            save_db(db, (cache.kind, uid))
+            for hook in cache.on_expire:
+                try:
+                    await hook(bot, uid)
+                except Exception:
+                    pass
+
+
+async def _sanction_sweeper(bot) -> None:
+    while True:
+        await asyncio.sleep(SANCTION_SWEEP_INTERVAL)
+        try:
+            await sweep_sanctions(bot)
+        except Exception as e:
+            print(f"⚠️ Ошибка чистки санкций: {e}")
+
+
+async def _notify_unmuted(bot, uid: int) -> None:
+    if _is_bot_uid(uid):
+        return
+    await bot.send_message(chat_id=uid, text="🔊 Срок мута истёк — можно снова вставать в очередь.")
+
+
+MUTES.on_expire.append(_notify_unmuted)
 
 
 async def gate(update: Update, need_reg: bool = True, need_unmute: bool = False) -> bool:
@@ -173,12 +2114,18 @@ def parse_duration(s: str) -> Optional[int]:
 
 
 def lobby_text(mode: str, queue: List[int]) -> str:
+    key = ("lobby", mode, tuple(queue), PLAYERS_VERSION.version)
+    return RENDER_CACHE.get(key, lambda: _render_lobby_text(mode, queue))
+
+
+def _render_lobby_text(mode: str, queue: List[int]) -> str:
     size  = LOBBY_5V5_SIZE if mode == "5v5" else LOBBY_2V2_SIZE
     emoji = "🎮" if mode == "5v5" else "⚡"
     lines = [f"{emoji} <b>Лобби {mode.upper()}</b>  {len(queue)}/{size}\n━━━━━━━━━━━━━━━━━━━━━"]
     if queue:
+        ps = get_players(queue)
         for i, uid in enumerate(queue, 1):
-            p = get_player(uid)
+            p = ps[uid]
             lines.append(
                 f"{i}. {p.lvl_icon()} {p.tg_link()} "
                 f"<code>[{p.external_id or '?'}]</code> • <b>{p.elo}</b> ELO"
@@ -189,27 +2136,89 @@ def lobby_text(mode: str, queue: List[int]) -> str:
     return "\n".join(lines)
 
 
-def lobby_kb(mode: str, uid: int, queue: List[int]) -> InlineKeyboardMarkup:
+def lobby_kb(mode: str) -> InlineKeyboardMarkup:
     """
-    Кнопка всегда показывает актуальное состояние ТОЛЬКО для того юзера,
-    который нажимает — но так как в Telegram одна клавиатура на всех,
-    мы показываем "Присоединиться" если юзер НЕ в очереди, и "Выйти" если в очереди.
-    Каждый раз при /play5 или /play2 отправляется НОВОЕ сообщение.
+    Клавиатура в Telegram одна на всех, поэтому в сообщении лобби
+    всегда обе кнопки — войти и выйти.
     """
-    if uid in queue:
-        btn = InlineKeyboardButton("❌ Выйти из очереди", callback_data=f"leave_{mode}")
-    else:
-        btn = InlineKeyboardButton("✅ Присоединиться",   callback_data=f"join_{mode}")
-    return InlineKeyboardMarkup([[btn]])
+    return RENDER_CACHE.get(("lobby_kb", mode), lambda: _render_lobby_kb(mode))
+
+
+def _render_lobby_kb(mode: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Присоединиться", callback_data=f"join_{mode}"),
+        InlineKeyboardButton("❌ Выйти",          callback_data=f"leave_{mode}"),
+    ]])
+
+
+class LobbyBoard:
+    """
+    Постоянные сообщения лобби: по одному на чат и режим, реестр
+    хранится в db["lobbies"]. Подключён индексом к очереди режима —
+    любое сохранённое изменение очереди уходит правкой во все
+    открытые сообщения этого режима через EDITS. Пока бот не запущен
+    (bot is None), ничего не рассылается.
+    """
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.bot  = None
+
+    def rebuild(self, queue: List[int]) -> None:
+        self.push(queue)
+
+    def update(self, key: str, queue: Optional[List[int]]) -> None:
+        self.push(queue or [])
+
+    def push(self, queue: List[int]) -> None:
+        if self.bot is None:
+            return
+        text, kb = lobby_text(self.mode, queue), lobby_kb(self.mode)
+        for lobby in load_db().get("lobbies", {}).values():
+            if lobby["mode"] == self.mode:
+                EDITS.submit(self.bot, lobby["chat_id"], lobby["message_id"], text, kb)
+
+
+LOBBY_BOARDS = {mode: LobbyBoard(mode) for mode in ("5v5", "2v2")}
+for _mode, _board in LOBBY_BOARDS.items():
+    STATE.add_index(f"queue_{_mode}", _board)
+
+
+def lobby_key(chat_id: int, mode: str) -> str:
+    return f"{chat_id}:{mode}"
+
+
+def register_lobby(db: Dict, chat_id: int, mode: str, message_id: int) -> None:
+    key = lobby_key(chat_id, mode)
+    db.setdefault("lobbies", {})[key] = {"chat_id": chat_id, "mode": mode, "message_id": message_id}
+    save_db(db, ("lobbies", key))
+
+
+def _forget_lobby_message(chat_id: int, message_id: int) -> None:
+    """Сообщение лобби удалили — убираем его из реестра, /play откроет новое."""
+    db = load_db()
+    for key, lobby in list(db.get("lobbies", {}).items()):
+        if lobby["chat_id"] == chat_id and lobby["message_id"] == message_id:
+            del db["lobbies"][key]
+            save_db(db, ("lobbies", key))
+
+
+EDITS.on_gone.append(_forget_lobby_message)
 
 # ════════════════════════════════════════════════
 #              СОЗДАНИЕ МАТЧА
 # ════════════════════════════════════════════════
 
 def _pick_buttons(m_id: str, pool: List[int]) -> List[List[InlineKeyboardButton]]:
+    key = ("pick", m_id, tuple(pool), PLAYERS_VERSION.version)
+    return RENDER_CACHE.get(key, lambda: _render_pick_buttons(m_id, pool))
+
+
+def _render_pick_buttons(m_id: str, pool: List[int]) -> List[List[InlineKeyboardButton]]:
     rows = []
+    ps   = get_players(pool)
     for uid in pool:
-        p = get_player(uid)
+        p = ps[uid]
         label = f"{p.lvl_icon()} {p.nickname} [{p.external_id or '?'}] | {p.avg:.1f}%"
         rows.append([InlineKeyboardButton(label, callback_data=f"pk_{m_id}_{uid}")])
     return rows
@@ -220,141 +2229,145 @@ def _is_bot_uid(uid: int) -> bool:
     return uid < 0
 
 
-async def _bot_auto_pick(m_id: str, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+def schedule_bot_turn(job_queue, m_id: str, chat_id: int) -> None:
     """
-    Авто-пик/бан для бота-капитана. Вызывается через job_queue с задержкой.
-    Бот случайно выбирает игрока из пула или банит карту.
+    Планирует ход бота-капитана отдельной задачей JobQueue с задержкой
+    BOT_TURN_DELAY. Обработчик апдейта освобождается сразу, а каждая
+    задача короткая: перечитывает матч, делает один пик/бан и, если
+    следующий ход тоже за ботом, планирует следующую задачу.
     """
-    import asyncio
-    await asyncio.sleep(2)   # небольшая задержка для реалистичности
-
-    db = load_db()
-    m  = db["active_matches"].get(m_id)
+    m = load_db()["active_matches"].get(m_id)
     if not m:
         return
+    job_queue.run_once(
+        _bot_turn_job, BOT_TURN_DELAY,
+        data={"m_id": m_id, "chat_id": chat_id, "rev": m.rev},
+        name=f"bot_turn_{m_id}",
+    )
 
-    turn = m["turn"]
-    if not _is_bot_uid(turn):
-        return  # сейчас ход живого игрока — не вмешиваемся
 
-    ct_cap = m["ct"][0]
-    t_cap  = m["t"][0]
-    phase  = m.get("phase", "pick")
+async def _bot_turn_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Авто-пик/бан для бота-капитана. Вызывается через job_queue с задержкой.
+    Бот случайно выбирает игрока из пула или банит карту.
+    """
+    data    = context.job.data
+    m_id    = data["m_id"]
+    chat_id = data["chat_id"]
 
-    if phase == "pick" and m["pool"]:
-        # Бот выбирает случайного игрока
-        chosen = random.choice(m["pool"])
-        if turn == ct_cap:
-            m["ct"].append(chosen)
+    async with match_lock(m_id):
+        db = load_db()
+        m  = match_cas(db, m_id, data["rev"])
+        if not m or not _is_bot_uid(m.turn):
+            return  # матч закрыт, ход уже сделан или сейчас ход живого игрока
+
+        phase = m.phase
+        if phase == "pick" and m.pool:
+            again = await _bot_pick_turn(db, m_id, m, context, chat_id)
+        elif phase == "ban" and len(m.maps) > 1:
+            again = await _bot_ban_turn(db, m_id, m, context, chat_id)
         else:
-            m["t"].append(chosen)
-        m["pool"].remove(chosen)
-
-        # Авто-добавляем последнего если остался 1
-        if len(m["pool"]) == 1:
-            last = m["pool"].pop(0)
-            if len(m["ct"]) <= len(m["t"]):
-                m["ct"].append(last)
-            else:
-                m["t"].append(last)
+            again = False
 
-        bot_p = get_player(turn)
+    if again:
+        schedule_bot_turn(context.job_queue, m_id, chat_id)
 
-        if m["pool"]:
-            m["turn"] = t_cap if turn == ct_cap else ct_cap
-            cur_side  = "🔵 CT" if m["turn"] == ct_cap else "🔴 T"
-            txt = (
-                f"🤖 <b>{bot_p.nickname}</b> выбрал {get_player(chosen).nickname}\n\n"
-                f"🎯 <b>Пик | Матч #{m_id} [{m['mode'].upper()}]</b>\n"
-                f"CT: {len(m['ct'])} | T: {len(m['t'])}\n"
-                f"Ход: {cur_side}"
-            )
-            save_db(db)
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id, text=txt,
-                    reply_markup=InlineKeyboardMarkup(_pick_buttons(m_id, m["pool"])),
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
-            # Если следующий тоже бот — снова авто-пик
-            if _is_bot_uid(m["turn"]):
-                await _bot_auto_pick(m_id, context, chat_id)
-        else:
-            # Пик завершён
-            m["phase"] = "ban"
-            m["turn"]  = ct_cap
 
-            def pline(u: int) -> str:
-                p = get_player(u)
-                return f"  • {p.tg_link()} <code>[{p.external_id or '?'}]</code>"
+async def _bot_pick_turn(db: Dict, m_id: str, m: Match,
+                         context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    """Один пик бота-капитана. True — следующий ход тоже за ботом."""
+    turn   = m.turn
+    ct_cap = m.ct[0]
+    t_cap  = m.t[0]
 
-            ct_list = "\n".join(pline(u) for u in m["ct"])
-            t_list  = "\n".join(pline(u) for u in m["t"])
-            txt = (
-                f"🤖 <b>{bot_p.nickname}</b> выбрал {get_player(chosen).nickname}\n\n"
-                f"✅ <b>Матч #{m_id} — пик завершён</b>\n\n"
-                f"🔵 CT:\n{ct_list}\n\n"
-                f"🔴 T:\n{t_list}\n\n"
-                f"🗺 <b>Баны карт — ход: {'🔵 CT' if ct_cap == m['turn'] else '🔴 T'}</b>"
-            )
-            ban_btns = [
-                [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
-                for mn in m["maps"]
-            ]
-            save_db(db)
-            try:
-                await context.bot.send_message(
-                    chat_id=chat_id, text=txt,
-                    reply_markup=InlineKeyboardMarkup(ban_btns),
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
-            # Если капитан банов тоже бот — авто-бан
-            if _is_bot_uid(m["turn"]):
-                await _bot_auto_ban(m_id, context, chat_id)
+    # Бот выбирает случайного игрока
+    chosen = random.choice(m.pool)
+    if turn == ct_cap:
+        m.ct.append(chosen)
+    else:
+        m.t.append(chosen)
+    m.pool.remove(chosen)
+
+    # Авто-добавляем последнего если остался 1
+    if len(m.pool) == 1:
+        last = m.pool.pop(0)
+        if len(m.ct) <= len(m.t):
+            m.ct.append(last)
+        else:
+            m.t.append(last)
 
-    elif phase == "ban" and m.get("maps"):
-        await _bot_auto_ban(m_id, context, chat_id)
+    names = get_players([turn, chosen])
+    bot_p = names[turn]
 
+    if m.pool:
+        m.turn    = t_cap if turn == ct_cap else ct_cap
+        cur_side  = "🔵 CT" if m.turn == ct_cap else "🔴 T"
+        txt = (
+            f"🤖 <b>{bot_p.nickname}</b> выбрал {names[chosen].nickname}\n\n"
+            f"🎯 <b>Пик | Матч #{m_id} [{m.mode.upper()}]</b>\n"
+            f"CT: {len(m.ct)} | T: {len(m.t)}\n"
+            f"Ход: {cur_side}"
+        )
+        commit_match(db, m_id)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id, text=txt,
+                reply_markup=InlineKeyboardMarkup(_pick_buttons(m_id, m.pool)),
+                parse_mode=ParseMode.HTML
+            )
+        except Exception:
+            pass
+    else:
+        # Пик завершён
+        begin_ban_phase(m)
 
-async def _bot_auto_ban(m_id: str, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Авто-бан карты ботом-капитаном."""
-    import asyncio
-    await asyncio.sleep(2)
+        ct_list = team_list(m.ct)
+        t_list  = team_list(m.t)
+        txt = (
+            f"🤖 <b>{bot_p.nickname}</b> выбрал {names[chosen].nickname}\n\n"
+            f"✅ <b>Матч #{m_id} — пик завершён</b>\n\n"
+            f"🔵 CT:\n{ct_list}\n\n"
+            f"🔴 T:\n{t_list}\n\n"
+            f"🗺 <b>Баны карт — ход: {'🔵 CT' if ct_cap == m.turn else '🔴 T'}</b>"
+        )
+        ban_btns = [
+            [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
+            for mn in m.maps
+        ]
+        commit_match(db, m_id)
+        schedule_deadline(context.job_queue, m_id)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id, text=txt,
+                reply_markup=InlineKeyboardMarkup(ban_btns),
+                parse_mode=ParseMode.HTML
+            )
+        except Exception:
+            pass
 
-    db = load_db()
-    m  = db["active_matches"].get(m_id)
-    if not m or not m.get("maps"):
-        return
+    # Если следующий ход тоже за ботом — JobQueue запланирует его отдельно
+    return _is_bot_uid(m.turn)
 
-    turn = m["turn"]
-    if not _is_bot_uid(turn):
-        return
 
-    ct_cap   = m["ct"][0]
-    t_cap    = m["t"][0]
-    map_name = random.choice(m["maps"])
+async def _bot_ban_turn(db: Dict, m_id: str, m: Match,
+                        context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    """Один бан карты ботом-капитаном. True — следующий ход тоже за ботом."""
+    turn     = m.turn
+    ct_cap   = m.ct[0]
+    t_cap    = m.t[0]
+    map_name = random.choice(m.maps)
     bot_p    = get_player(turn)
 
-    m["maps"].remove(map_name)
-    m["banned_maps"].append(map_name)
-
-    if len(m["maps"]) == 1:
-        final_map  = m["maps"][0]
-        banned_str = ", ".join(m["banned_maps"])
+    ban_map(m, map_name)
 
-        def pline(u: int) -> str:
-            p = get_player(u)
-            return f"  • {p.tg_link()} <code>[{p.external_id or '?'}]</code>"
-
-        ct_list = "\n".join(pline(u) for u in m["ct"])
-        t_list  = "\n".join(pline(u) for u in m["t"])
+    if len(m.maps) == 1:
+        final_map  = m.maps[0]
+        banned_str = ", ".join(m.banned_maps)
+        ct_list = team_list(m.ct)
+        t_list  = team_list(m.t)
         txt = (
             f"🤖 <b>{bot_p.nickname}</b> забанил {map_name}\n\n"
-            f"🏁 <b>Матч #{m_id} [{m['mode'].upper()}] — всё готово!</b>\n\n"
+            f"🏁 <b>Матч #{m_id} [{m.mode.upper()}] — всё готово!</b>\n\n"
             f"🔵 CT:\n{ct_list}\n\n"
             f"🔴 T:\n{t_list}\n\n"
             f"🗺 Карта: <b>{final_map}</b>\n"
@@ -362,26 +2375,27 @@ async def _bot_auto_ban(m_id: str, context: ContextTypes.DEFAULT_TYPE, chat_id:
             f"Введите результат:\n"
             f"<code>/win {m_id} ct</code>  или  <code>/win {m_id} t</code>"
         )
-        save_db(db)
+        commit_match(db, m_id)
+        schedule_deadline(context.job_queue, m_id)   # карта выбрана — таймер банов снимается
         try:
             await context.bot.send_message(chat_id=chat_id, text=txt, parse_mode=ParseMode.HTML)
         except Exception:
             pass
-        return
+        return False
 
-    m["turn"] = t_cap if turn == ct_cap else ct_cap
-    cur_side  = "🔵 CT" if m["turn"] == ct_cap else "🔴 T"
+    m.turn    = t_cap if turn == ct_cap else ct_cap
+    cur_side  = "🔵 CT" if m.turn == ct_cap else "🔴 T"
     ban_btns  = [
         [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
-        for mn in m["maps"]
+        for mn in m.maps
     ]
     txt = (
         f"🤖 <b>{bot_p.nickname}</b> забанил {map_name}\n\n"
         f"🗺 <b>Баны карт | Матч #{m_id}</b>\n"
-        f"Осталось: {len(m['maps'])} карт\n"
+        f"Осталось: {len(m.maps)} карт\n"
         f"Ход: {cur_side}"
     )
-    save_db(db)
+    commit_match(db, m_id)
     try:
         await context.bot.send_message(
             chat_id=chat_id, text=txt,
@@ -391,8 +2405,206 @@ async def _bot_auto_ban(m_id: str, context: ContextTypes.DEFAULT_TYPE, chat_id:
     except Exception:
         pass
     # Если следующий тоже бот
-    if _is_bot_uid(m["turn"]):
-        await _bot_auto_ban(m_id, context, chat_id)
+    return _is_bot_uid(m.turn)
+
+
+def take_lobby(db: Dict, mode: str) -> Optional[List[int]]:
+    """
+    Собирает лобби из очереди mode и убирает его игроков из очереди.
+    Вызывать под queue_lock. None — лобби пока не собирается.
+    """
+    key   = f"queue_{mode}"
+    queue = db.get(key, [])
+    size  = LOBBY_5V5_SIZE if mode == "5v5" else LOBBY_2V2_SIZE
+    if MATCHMAKING == "elo":
+        lobby = MATCHMAKERS[mode].find_lobby()
+    else:
+        lobby = queue[:size] if len(queue) >= size else None
+    if not lobby:
+        return None
+    taken   = set(lobby)
+    db[key] = [u for u in queue if u not in taken]
+    save_db(db, key)
+    return lobby
+
+
+async def _matchmaking_tick(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Периодическая попытка собрать лобби: допуск по ELO растёт со временем,
+    так что очередь, которая не собиралась при входе, может собраться позже.
+    """
+    db = load_db()
+    for mode, mm in MATCHMAKERS.items():
+        async with queue_lock("2v2"), queue_lock("5v5"):
+            lobby = mm.find_lobby()
+            chat  = mm.chat_for(lobby) if lobby else None
+            if chat is None:
+                continue
+            lobby = take_lobby(db, mode)
+        if lobby:
+            await start_match(lobby, mode, db, context, chat)
+
+
+def auto_balance_enabled(db: Dict, mode: str) -> bool:
+    return db.get("settings", {}).get("auto_balance", {}).get(mode, AUTO_BALANCE.get(mode, False))
+
+
+def balance_teams(players: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    Делит лобби на две равные команды с минимальной разницей суммарного
+    ELO полным перебором (для 10 игроков — 126 вариантов: первый игрок
+    фиксирован в команде A). Каждая команда упорядочена по убыванию ELO,
+    так что капитаном становится её сильнейший игрок.
+    """
+    ps    = get_players(players)
+    elo   = {u: ps[u].elo for u in players}
+    total = sum(elo.values())
+    first, rest = players[0], players[1:]
+    best, best_diff = None, None
+    for combo in combinations(rest, len(players) // 2 - 1):
+        a    = (first,) + combo
+        diff = abs(total - 2 * sum(elo[u] for u in a))
+        if best_diff is None or diff < best_diff:
+            best, best_diff = a, diff
+            if diff == 0:
+                break
+    team_a = set(best)
+    a = sorted(best, key=lambda u: elo[u], reverse=True)
+    b = sorted((u for u in players if u not in team_a), key=lambda u: elo[u], reverse=True)
+    return (a, b) if random.random() < 0.5 else (b, a)
+
+
+def begin_ban_phase(m: Match) -> None:
+    """Переводит матч из пика в баны: первым банит CT, запускается таймер банов."""
+    m.phase          = "ban"
+    m.turn           = m.ct[0]
+    m.ban_start_time = time.time()
+
+
+def ban_map(m: Match, map_name: str) -> None:
+    """Банит карту; когда остаётся одна — запоминает момент выбора карты."""
+    m.maps.remove(map_name)
+    m.banned_maps.append(map_name)
+    if len(m.maps) == 1:
+        m.live_time = time.time()
+
+
+def match_deadline(m: Match) -> float:
+    """Момент, когда истекает текущая фаза матча (пик или баны)."""
+    if m.phase == "ban":
+        return (m.ban_start_time or m.pick_start_time) + m.ban_timeout
+    return m.pick_start_time + m.pick_timeout
+
+
+def schedule_deadline(job_queue, m_id: str) -> None:
+    """
+    Ставит (или переставляет) задачу JobQueue на дедлайн текущей фазы
+    матча. Матч с уже выбранной картой ждёт /win и таймера не имеет.
+    """
+    name = f"deadline_{m_id}"
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    m = load_db()["active_matches"].get(m_id)
+    if not m or len(m.maps) <= 1:
+        return
+    job_queue.run_once(
+        _deadline_job, max(0.0, match_deadline(m) - time.time()),
+        data={"m_id": m_id, "phase": m.phase},
+        name=name,
+    )
+
+
+def cancel_match(db: Dict, m_id: str, drop: Optional[int] = None) -> List[int]:
+    """
+    Отменяет матч и возвращает живых игроков в начало их очереди;
+    drop (капитан, проспавший свой ход) в очередь не возвращается, иначе
+    то же лобби тут же соберётся снова с ним же капитаном. Время входа
+    в очередь у вернувшихся прежнее (его помнит MatchmakingQueue).
+    Вызывать под match_lock. Возвращает список возвращённых uid.
+    """
+    m = db["active_matches"].pop(m_id, None)
+    commit_match(db, m_id)
+    if not m:
+        return []
+    key     = f"queue_{m.mode}"
+    players = [u for u in m.ct + m.t + m.pool if not _is_bot_uid(u) and u != drop]
+    queued  = set(db.get("queue_5v5", [])) | set(db.get("queue_2v2", []))
+    back    = [u for u in players if u not in queued]
+    db[key] = back + db.get(key, [])
+    save_db(db, key)
+    return back
+
+
+async def _deadline_job(context: ContextTypes.DEFAULT_TYPE):
+    """Истёк таймер пика или банов: доигрываем ход за капитанов или отменяем матч."""
+    m_id  = context.job.data["m_id"]
+    phase = context.job.data["phase"]
+
+    async with match_lock(m_id):
+        db = load_db()
+        m  = db["active_matches"].get(m_id)
+        if not m or m.phase != phase or time.time() < match_deadline(m):
+            return  # фаза уже сменилась или таймер переставлен
+        if len(m.maps) <= 1:
+            return  # карта уже выбрана, матч ждёт /win
+        chat_id = m.chat_id
+
+        if phase == "pick" and PICK_TIMEOUT_ACTION == "cancel":
+            mode = m.mode
+            idle = m.turn
+            async with queue_lock(mode):
+                back = cancel_match(db, m_id, drop=idle)
+            txt = (
+                f"⏰ <b>Матч #{m_id}</b> — время на пик вышло, матч отменён.\n"
+                f"Игроков возвращено в очередь {mode.upper()}: {len(back)}"
+            )
+            if not _is_bot_uid(idle):
+                txt += f"\nКапитан {get_player(idle).tg_link()} пропустил ход и из очереди снят."
+            markup = None
+        elif phase == "pick":
+            # Случайно раскидываем оставшийся пул, как если бы пикали капитаны
+            random.shuffle(m.pool)
+            while m.pool:
+                side = m.ct if len(m.ct) <= len(m.t) else m.t
+                side.append(m.pool.pop())
+            begin_ban_phase(m)
+            commit_match(db, m_id)
+            schedule_deadline(context.job_queue, m_id)
+            txt = (
+                f"⏰ <b>Матч #{m_id}</b> — время на пик вышло, составы добраны случайно.\n\n"
+                f"🔵 CT:\n{team_list(m.ct)}\n\n"
+                f"🔴 T:\n{team_list(m.t)}\n\n"
+                f"🗺 <b>Баны карт — ход: 🔵 CT</b>"
+            )
+            markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
+                for mn in m.maps
+            ])
+            if _is_bot_uid(m.turn):
+                schedule_bot_turn(context.job_queue, m_id, chat_id)
+        else:
+            while len(m.maps) > 1:
+                map_name = random.choice(m.maps)
+                ban_map(m, map_name)
+            commit_match(db, m_id)
+            txt = (
+                f"⏰ Время на баны вышло — карты добанены случайно.\n\n"
+                f"🏁 <b>Матч #{m_id} [{m.mode.upper()}] — всё готово!</b>\n\n"
+                f"🔵 CT:\n{team_list(m.ct)}\n\n"
+                f"🔴 T:\n{team_list(m.t)}\n\n"
+                f"🗺 Карта: <b>{m.maps[0]}</b>\n"
+                f"🚫 Забанены: {', '.join(m.banned_maps)}\n\n"
+                f"Введите результат (только для администратора):\n"
+                f"<code>/win {m_id} ct</code>  или  <code>/win {m_id} t</code>"
+            )
+            markup = None
+
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id, text=txt, reply_markup=markup, parse_mode=ParseMode.HTML
+            )
+        except Exception:
+            pass
 
 
 async def start_match(players: List[int], mode: str, db: Dict,
@@ -400,28 +2612,41 @@ async def start_match(players: List[int], mode: str, db: Dict,
     db["match_counter"] += 1
     m_id   = str(db["match_counter"])
 
-    random.shuffle(players)
+    if auto_balance_enabled(db, mode):
+        await _start_balanced_match(m_id, players, mode, db, context, chat_id)
+        return
+
+    if MATCHMAKING == "elo":
+        # Капитаны — два сильнейших игрока лобби, сторона — жребий
+        ps      = get_players(players)
+        players = sorted(players, key=lambda u: ps[u].elo, reverse=True)
+        if random.random() < 0.5:
+            players[0], players[1] = players[1], players[0]
+    else:
+        random.shuffle(players)
     ct_cap = players[0]
     t_cap  = players[1]
     pool   = players[2:]
 
-    db["active_matches"][m_id] = {
-        "mode":            mode,
-        "ct":              [ct_cap],
-        "t":               [t_cap],
-        "pool":            pool,
-        "turn":            ct_cap,
-        "phase":           "pick",
-        "maps":            MAPS_LIST.copy(),
-        "banned_maps":     [],
-        "pick_start_time": time.time(),
-        "pick_timeout":    PICK_TIMEOUT,
-        "chat_id":         chat_id,
-    }
-    save_db(db)
+    db["active_matches"][m_id] = Match(
+        mode    = mode,
+        ct      = [ct_cap],
+        t       = [t_cap],
+        pool    = pool,
+        turn    = ct_cap,
+        chat_id = chat_id,
+    )
+    save_db(db, "match_counter", ("active_matches", m_id))
+    # Таймеры — до отправки: если объявление не уйдёт, матч всё равно
+    # закроется по дедлайну, а не повиснет до перезапуска
+    schedule_deadline(context.job_queue, m_id)
+    # Если первый капитан — бот, планируем авто-пик
+    if _is_bot_uid(ct_cap):
+        schedule_bot_turn(context.job_queue, m_id, chat_id)
 
-    ct_p = get_player(ct_cap)
-    t_p  = get_player(t_cap)
+    caps = get_players([ct_cap, t_cap])
+    ct_p = caps[ct_cap]
+    t_p  = caps[t_cap]
 
     txt = (
         f"🆕 <b>Матч #{m_id} [{mode.upper()}]</b>\n\n"
@@ -438,9 +2663,49 @@ async def start_match(players: List[int], mode: str, db: Dict,
         reply_markup = InlineKeyboardMarkup(btns) if btns else None,
         parse_mode   = ParseMode.HTML
     )
-    # Если первый капитан — бот, запускаем авто-пик
-    if _is_bot_uid(ct_cap):
-        await _bot_auto_pick(m_id, context, chat_id)
+
+
+async def _start_balanced_match(m_id: str, players: List[int], mode: str, db: Dict,
+                                context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Матч в режиме автобаланса: составы по ELO без драфта, сразу баны карт."""
+    ct, t = balance_teams(players)
+    m = Match(
+        mode         = mode,
+        ct           = ct,
+        t            = t,
+        pool         = [],
+        turn         = ct[0],
+        chat_id      = chat_id,
+        auto_balance = True,
+    )
+    begin_ban_phase(m)
+    db["active_matches"][m_id] = m
+    save_db(db, "match_counter", ("active_matches", m_id))
+    # Таймеры — до отправки, как в start_match
+    schedule_deadline(context.job_queue, m_id)
+    if _is_bot_uid(ct[0]):
+        schedule_bot_turn(context.job_queue, m_id, chat_id)
+
+    ps     = get_players(players)
+    ct_avg = sum(ps[u].elo for u in ct) / len(ct)
+    t_avg  = sum(ps[u].elo for u in t) / len(t)
+    txt = (
+        f"🆕 <b>Матч #{m_id} [{mode.upper()}]</b> — автобаланс\n\n"
+        f"🔵 CT (ср. {ct_avg:.0f} ELO):\n{team_list(ct)}\n\n"
+        f"🔴 T (ср. {t_avg:.0f} ELO):\n{team_list(t)}\n\n"
+        f"⚖️ Разница: <b>{abs(ct_avg - t_avg):.0f}</b> ELO\n\n"
+        f"🗺 <b>Баны карт — ход: 🔵 CT</b>"
+    )
+    ban_btns = [
+        [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
+        for mn in m.maps
+    ]
+    await context.bot.send_message(
+        chat_id      = chat_id,
+        text         = txt,
+        reply_markup = InlineKeyboardMarkup(ban_btns),
+        parse_mode   = ParseMode.HTML
+    )
 
 # ════════════════════════════════════════════════
 #              ПУБЛИЧНЫЕ КОМАНДЫ
@@ -459,6 +2724,8 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/play2 — Лобби 2v2\n"
             "/stats — Профиль\n"
             "/top — Топ игроков\n"
+            "/rank — Место в рейтинге\n"
+            "/mapstats — Статистика по картам\n"
             "/queue — Статус очередей"
         )
     else:
@@ -478,7 +2745,7 @@ async def reg_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     s   = str(uid)
     db  = load_db()
 
-    if s in db["players"] and db["players"][s].get("external_id"):
+    if s in db["players"] and db["players"][s].external_id:
         await update.message.reply_text(
             "🚫 Вы уже зарегистрированы.\n"
             "Для смены данных обратитесь к администратору."
@@ -501,13 +2768,12 @@ async def reg_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Уникальность FACEIT ID среди живых игроков
-    for d in db["players"].values():
-        if d.get("external_id") == faceit_id and not d.get("is_bot"):
-            await update.message.reply_text("🚫 Этот FACEIT ID уже зарегистрирован.")
-            return
+    if EXTERNAL_IDS.get(faceit_id) is not None:
+        await update.message.reply_text("🚫 Этот FACEIT ID уже зарегистрирован.")
+        return
 
-    db["players"][s] = asdict(Player(uid, nickname, faceit_id))
-    save_db(db)
+    db["players"][s] = Player(uid, nickname, faceit_id)
+    save_db(db, ("players", s))
     await update.message.reply_text(
         f"✅ <b>Зарегистрирован!</b>\n\n"
         f"👤 Никнейм: <b>{nickname}</b>\n"
@@ -534,85 +2800,325 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     total = p.wins + p.losses
     wr    = f"{p.avg:.1f}%" if total else "—"
-    await update.message.reply_text(
-        f"✦ {p.tg_link()} ✦\n"
-        f"🆔 <code>{p.external_id or 'не указан'}</code>\n"
-        f"━━━━━━━━━━━━━━━━━━━━━\n"
-        f"{p.lvl_icon()} <b>{p.elo}</b> ELO\n"
-        f"🏆 Побед: <b>{p.wins}</b>  💀 Поражений: <b>{p.losses}</b>\n"
-        f"📈 Winrate: <b>{wr}</b>  🎮 Матчей: <b>{total}</b>\n"
+    lines = [
+        f"✦ {p.tg_link()} ✦",
+        f"🆔 <code>{p.external_id or 'не указан'}</code>",
         f"━━━━━━━━━━━━━━━━━━━━━",
-        parse_mode=ParseMode.HTML
-    )
+        f"{p.lvl_icon()} <b>{p.elo}</b> ELO",
+        f"🏆 Побед: <b>{p.wins}</b>  💀 Поражений: <b>{p.losses}</b>",
+        f"📈 Winrate: <b>{wr}</b>  🎮 Матчей: <b>{total}</b>",
+    ]
+
+    st = STATS.get(target)
+    if st is not None:
+        ct, t = st["sides"]["ct"], st["sides"]["t"]
+        lines.append(f"🔵 CT: <b>{winrate(ct)}</b> ({sum(ct)})  🔴 T: <b>{winrate(t)}</b> ({sum(t)})")
+        if st["maps"]:
+            best, wl = max(st["maps"].items(), key=lambda kv: (kv[1][0] / sum(kv[1]), sum(kv[1])))
+            lines.append(f"🗺 Лучшая карта: <b>{best}</b> — {winrate(wl)} ({sum(wl)})")
+        # Самый частый тиммейт и самый неудобный соперник
+        if st["mates"]:
+            mate, wl = max(st["mates"].items(), key=lambda kv: sum(kv[1]))
+            lines.append(f"🤝 Чаще всего с: {get_player(mate).nickname} — {wl[0]}:{wl[1]}")
+        if st["opps"]:
+            opp, wl = max(st["opps"].items(), key=lambda kv: (kv[1][1] - kv[1][0], sum(kv[1])))
+            if wl[1] > wl[0]:
+                lines.append(f"⚔️ Неудобный соперник: {get_player(opp).nickname} — {wl[0]}:{wl[1]}")
+        series = [elo for _, elo in st["elo"]]
+        if len(series) > 1:
+            lines.append(f"📉 ELO: {series[0]} {sparkline(series)} {series[-1]}")
+    lines.append("━━━━━━━━━━━━━━━━━━━━━")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def mapstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await gate(update): return
+    load_db()
+
+    # /mapstats all — общая статистика карт
+    if context.args and context.args[0].lower() == "all":
+        if not STATS.maps:
+            await update.message.reply_text("🗺 Сыгранных матчей пока нет."); return
+        lines = [f"🗺 <b>Карты</b> — матчей: {STATS.matches}\n━━━━━━━━━━━━━━━"]
+        for map_, (n, ct_wins) in sorted(STATS.maps.items(), key=lambda kv: -kv[1][0]):
+            lines.append(f"<b>{map_}</b>: {n} игр | CT {ct_wins / n * 100:.0f}% / T {(n - ct_wins) / n * 100:.0f}%")
+        await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+        return
+
+    target = update.effective_user.id
+    if context.args:
+        try:
+            target = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Формат: /mapstats [user_id|all]"); return
+
+    p  = get_player(target)
+    st = STATS.get(target)
+    if st is None or not st["maps"]:
+        await update.message.reply_text("🗺 Сыгранных матчей пока нет."); return
+    lines = [f"🗺 <b>Карты</b> — {p.tg_link()}\n━━━━━━━━━━━━━━━"]
+    for map_, wl in sorted(st["maps"].items(), key=lambda kv: -sum(kv[1])):
+        lines.append(f"<b>{map_}</b>: {wl[0]}W / {wl[1]}L — {winrate(wl)}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 
 async def top_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await gate(update): return
-    db      = load_db()
-    # Боты полностью исключены
-    players = [
-        Player(**d) for d in db["players"].values()
-        if d.get("external_id") and not d.get("is_bot")
-    ]
-    if not players:
+    load_db()
+    # Боты в рейтинг не попадают (см. Leaderboard)
+    total = len(LEADERBOARD)
+    if not total:
         await update.message.reply_text("🏆 Рейтинг пока пуст.")
         return
 
-    players.sort(key=lambda p: p.elo, reverse=True)
-    medals = ["🥇","🥈","🥉","4️⃣","5️⃣","6️⃣","7️⃣","8️⃣","9️⃣","🔟"]
-    lines  = ["🏆 <b>Топ-10 игроков</b>\n━━━━━━━━━━━━━━━"]
-    for i, p in enumerate(players[:10]):
+    txt = RENDER_CACHE.get(("top", PLAYERS_VERSION.version), _render_top)
+    await update.message.reply_text(txt, parse_mode=ParseMode.HTML)
+
+
+def _render_top() -> str:
+    total   = len(LEADERBOARD)
+    top_ids = LEADERBOARD.top(10)
+    ps      = get_players(top_ids)
+    medals  = ["🥇","🥈","🥉","4️⃣","5️⃣","6️⃣","7️⃣","8️⃣","9️⃣","🔟"]
+    lines   = ["🏆 <b>Топ-10 игроков</b>\n━━━━━━━━━━━━━━━"]
+    for i, p in enumerate(ps[u] for u in top_ids):
         wr = f"{p.avg:.1f}%" if (p.wins+p.losses) else "—"
         lines.append(
             f"{medals[i]} {p.lvl_icon()} {p.tg_link()} <code>[{p.external_id}]</code>\n"
             f"    ELO: <b>{p.elo}</b> | WR: <b>{wr}</b> | Игр: <b>{p.wins+p.losses}</b>"
         )
-    if len(players) > 10:
-        lines.append(f"\n... и ещё {len(players)-10} в рейтинге")
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    if total > 10:
+        lines.append(f"\n... и ещё {total-10} в рейтинге")
+    return "\n".join(lines)
+
+
+async def rank_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await gate(update): return
+    target = update.effective_user.id
+    if context.args:
+        try:
+            target = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Формат: /rank [user_id]"); return
+
+    load_db()
+    place = LEADERBOARD.rank(target)
+    if place is None:
+        await update.message.reply_text("Игрока нет в рейтинге.")
+        return
+    p = get_player(target)
+    await update.message.reply_text(
+        f"🏅 {p.tg_link()} — <b>#{place}</b> из {len(LEADERBOARD)}\n"
+        f"{p.lvl_icon()} <b>{p.elo}</b> ELO",
+        parse_mode=ParseMode.HTML
+    )
+
+
+async def open_lobby(update: Update, context: ContextTypes.DEFAULT_TYPE, mode: str):
+    """
+    В чате живёт одно сообщение лобби на режим. Если оно уже есть —
+    отвечаем ссылкой на него, иначе отправляем новое и запоминаем.
+    """
+    chat_id = update.message.chat_id
+    db      = load_db()
+    lobby   = db.get("lobbies", {}).get(lobby_key(chat_id, mode))
+    if lobby is not None:
+        try:
+            await update.message.reply_text(
+                f"👆 Лобби {mode.upper()} уже открыто — жми кнопки в нём.",
+                reply_to_message_id=lobby["message_id"]
+            )
+            return
+        except BadRequest:
+            pass   # сообщение удалили — откроем новое
+
+    msg = await update.message.reply_text(
+        lobby_text(mode, db.get(f"queue_{mode}", [])),
+        reply_markup=lobby_kb(mode),
+        parse_mode=ParseMode.HTML
+    )
+    register_lobby(db, chat_id, mode, msg.message_id)
 
 
 async def play5_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Открывает лобби 5v5 — всегда отправляет НОВОЕ сообщение."""
+    """Лобби 5v5 — одно живое сообщение на чат."""
     if await gate(update, need_unmute=True): return
-    uid = update.effective_user.id
-    db  = load_db()
-    q   = db.get("queue_5v5", [])
+    await open_lobby(update, context, "5v5")
+
+
+async def play2_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Лобби 2v2 — одно живое сообщение на чат."""
+    if await gate(update, need_unmute=True): return
+    await open_lobby(update, context, "2v2")
+
+
+async def queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if await gate(update): return
+    db = load_db()
+    q5 = db.get("queue_5v5", [])
+    q2 = db.get("queue_2v2", [])
     await update.message.reply_text(
-        lobby_text("5v5", q),
-        reply_markup=lobby_kb("5v5", uid, q),
+        f"📊 <b>Очереди</b>\n\n"
+        f"🎮 5v5: {len(q5)}/{LOBBY_5V5_SIZE}\n"
+        f"⚡ 2v2: {len(q2)}/{LOBBY_2V2_SIZE}",
         parse_mode=ParseMode.HTML
     )
 
+# ════════════════════════════════════════════════
+#             CALLBACK — ЛОББИ / ПИК / БАН
+# ════════════════════════════════════════════════
+
+# Шаги пика и бана выполняются под match_lock целиком синхронно: проверки,
+# изменение матча, commit_match и планирование задач без единого await.
+# Ответ в Telegram (алерт или правка сообщения) уходит уже после того,
+# как замок отпущен.
+CallbackOutcome = Tuple[Optional[str], Optional[Dict[str, Any]]]   # алерт, правка сообщения
+
+
+def _pick_step(db: Dict, m_id: str, uid: int, p_id: int, job_queue, chat_id: int) -> CallbackOutcome:
+    m = db["active_matches"].get(m_id)
+    if not m:
+        return "Матч уже завершён", None
+
+    ct_cap = m.ct[0]
+    t_cap  = m.t[0]
+
+    # Только капитаны могут пикать
+    if uid not in (ct_cap, t_cap):
+        return "🚫 Только капитан может выбирать игроков!", None, False
+
+    if uid != m.turn:
+        return f"Сейчас ход {get_player(m.turn).nickname}!", None, False
+
+    # Таймаут — сам матч закроет планировщик дедлайнов
+    if time.time() > match_deadline(m):
+        return "⏰ Время на пик вышло!", None, False
+
+    if p_id not in m.pool:
+        return "Этот игрок уже выбран!", None, False
+
+    # Добавляем в команду
+    if uid == ct_cap:
+        m.ct.append(p_id)
+    else:
+        m.t.append(p_id)
+    m.pool.remove(p_id)
+
+    # Если остался 1 — авто-добавляем
+    if len(m.pool) == 1:
+        last = m.pool.pop(0)
+        if len(m.ct) <= len(m.t):
+            m.ct.append(last)
+        else:
+            m.t.append(last)
+
+    if m.pool:
+        m.turn      = t_cap if uid == ct_cap else ct_cap
+        elapsed     = time.time() - m.pick_start_time
+        remaining   = max(0, int(m.pick_timeout - elapsed))
+        cur_side    = "🔵 CT" if m.turn == ct_cap else "🔴 T"
+        commit_match(db, m_id)
+        edit = {
+            "text": (
+                f"🎯 <b>Пик | Матч #{m_id} [{m.mode.upper()}]</b>\n"
+                f"CT: {len(m.ct)} | T: {len(m.t)}\n"
+                f"Ход: {cur_side}  ⏳ {remaining} сек"
+            ),
+            "reply_markup": InlineKeyboardMarkup(_pick_buttons(m_id, m.pool)),
+        }
+        # Если следующий ход — бот, запускаем авто-пик
+        if _is_bot_uid(m.turn):
+            schedule_bot_turn(job_queue, m_id, m.chat_id or chat_id)
+        return None, edit
+
+    # Пик завершён → переходим к банам карт
+    begin_ban_phase(m)
+    commit_match(db, m_id)
+    schedule_deadline(job_queue, m_id)
+    ban_btns = [
+        [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
+        for mn in m.maps
+    ]
+    edit = {
+        "text": (
+            f"✅ <b>Матч #{m_id} — пик завершён</b>\n\n"
+            f"🔵 CT:\n{team_list(m.ct)}\n\n"
+            f"🔴 T:\n{team_list(m.t)}\n\n"
+            f"🗺 <b>Баны карт — ход: 🔵 CT</b>"
+        ),
+        "reply_markup": InlineKeyboardMarkup(ban_btns),
+    }
+    # Если капитан банов — бот, запускаем авто-бан
+    if _is_bot_uid(ct_cap):
+        schedule_bot_turn(job_queue, m_id, m.chat_id or chat_id)
+    return None, edit
+
+
+def _ban_step(db: Dict, m_id: str, uid: int, map_name: str, job_queue, chat_id: int) -> CallbackOutcome:
+    m = db["active_matches"].get(m_id)
+    if not m:
+        return "Матч не найден", None
+
+    ct_cap = m.ct[0]
+    t_cap  = m.t[0]
 
-async def play2_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Открывает лобби 2v2 — всегда отправляет НОВОЕ сообщение."""
-    if await gate(update, need_unmute=True): return
-    uid = update.effective_user.id
-    db  = load_db()
-    q   = db.get("queue_2v2", [])
-    await update.message.reply_text(
-        lobby_text("2v2", q),
-        reply_markup=lobby_kb("2v2", uid, q),
-        parse_mode=ParseMode.HTML
-    )
+    # Только капитаны банят карты
+    if uid not in (ct_cap, t_cap):
+        return "🚫 Только капитан может банить карты!", None, False
 
+    if uid != m.turn:
+        return f"Сейчас ход {get_player(m.turn).nickname}!", None, False
 
-async def queue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if await gate(update): return
-    db = load_db()
-    q5 = db.get("queue_5v5", [])
-    q2 = db.get("queue_2v2", [])
-    await update.message.reply_text(
-        f"📊 <b>Очереди</b>\n\n"
-        f"🎮 5v5: {len(q5)}/{LOBBY_5V5_SIZE}\n"
-        f"⚡ 2v2: {len(q2)}/{LOBBY_2V2_SIZE}",
-        parse_mode=ParseMode.HTML
-    )
+    if map_name not in m.maps:
+        return "Карта уже забанена", None, False
+
+    ban_map(m, map_name)
+
+    if len(m.maps) == 1:
+        commit_match(db, m_id)
+        schedule_deadline(job_queue, m_id)   # карта выбрана — таймер банов снимается
+        edit = {"text": (
+            f"🏁 <b>Матч #{m_id} [{m.mode.upper()}] — всё готово!</b>\n\n"
+            f"🔵 CT:\n{team_list(m.ct)}\n\n"
+            f"🔴 T:\n{team_list(m.t)}\n\n"
+            f"🗺 Карта: <b>{m.maps[0]}</b>\n"
+            f"🚫 Забанены: {', '.join(m.banned_maps)}\n\n"
+            f"Введите результат (только для администратора):\n"
+            f"<code>/win {m_id} ct</code>  или  <code>/win {m_id} t</code>"
+        )}
+        return None, edit
+
+    m.turn    = t_cap if uid == ct_cap else ct_cap
+    cur_side  = "🔵 CT" if m.turn == ct_cap else "🔴 T"
+    commit_match(db, m_id)
+    ban_btns  = [
+        [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
+        for mn in m.maps
+    ]
+    edit = {
+        "text": (
+            f"🗺 <b>Баны карт | Матч #{m_id}</b>\n"
+            f"Осталось: {len(m.maps)} карт\n"
+            f"Ход: {cur_side}"
+        ),
+        "reply_markup": InlineKeyboardMarkup(ban_btns),
+    }
+    # Если следующий ход — бот, авто-бан
+    if _is_bot_uid(m.turn):
+        schedule_bot_turn(job_queue, m_id, m.chat_id or chat_id)
+    return None, edit
+
+
+async def _reply_callback(q, alert: Optional[str], edit: Optional[Dict[str, Any]]) -> None:
+    """Алерт нажавшему или правка сообщения матча — вне match_lock."""
+    try:
+        if alert:
+            await q.answer(alert, show_alert=True)
+        elif edit:
+            await q.edit_message_text(parse_mode=ParseMode.HTML, **edit)
+    except Exception:
+        pass
 
-# ════════════════════════════════════════════════
-#             CALLBACK — ЛОББИ / ПИК / БАН
-# ════════════════════════════════════════════════
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q   = update.callback_query
@@ -635,45 +3141,58 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not is_registered(uid) and uid not in ADMIN_IDS:
             await q.answer("🚫 Сначала /reg", show_alert=True); return
 
-        db    = load_db()
-        key   = f"queue_{mode}"
-        okey  = "queue_2v2" if mode == "5v5" else "queue_5v5"
-        queue = db.get(key, [])
-        size  = LOBBY_5V5_SIZE if mode == "5v5" else LOBBY_2V2_SIZE
-
-        if action == "join":
-            if uid in queue:
-                await q.answer("Вы уже в этой очереди!", show_alert=True); return
-            if uid in db.get(okey, []):
-                other = "2v2" if mode == "5v5" else "5v5"
-                await q.answer(f"Вы уже в очереди {other}!", show_alert=True); return
-            queue.append(uid)
-            await q.answer(f"✅ Вы в очереди {mode.upper()} ({len(queue)}/{size})")
-        else:
-            if uid not in queue:
-                await q.answer("Вас нет в этой очереди!", show_alert=True); return
-            queue.remove(uid)
-            await q.answer(f"❌ Вы вышли из очереди {mode.upper()}")
-
-        db[key] = queue
-        save_db(db)
+        # Под замком — только решение, изменение очереди и save_db, без await:
+        # ответ Telegram уходит уже после того, как замки отпущены.
+        match_players = None
+        match_chat    = q.message.chat_id
+        async with queue_lock("2v2"), queue_lock("5v5"):
+            db    = load_db()
+            key   = f"queue_{mode}"
+            okey  = "queue_2v2" if mode == "5v5" else "queue_5v5"
+            queue = db.get(key, [])
+            size  = LOBBY_5V5_SIZE if mode == "5v5" else LOBBY_2V2_SIZE
+            other = "2v2" if mode == "5v5" else "5v5"
+
+            joins = db.setdefault("queue_joins", {})
+            if action == "join" and uid in queue:
+                reply, changed = "Вы уже в этой очереди!", False
+            elif action == "join" and uid in db.get(okey, []):
+                reply, changed = f"Вы уже в очереди {other}!", False
+            elif action == "join":
+                db[key] = queue + [uid]
+                joins[str(uid)] = MATCHMAKERS[mode].note_join(uid, q.message.chat_id)
+                reply, changed = f"✅ Вы в очереди {mode.upper()} ({len(db[key])}/{size})", True
+            elif uid not in queue:
+                reply, changed = "Вас нет в этой очереди!", False
+            else:
+                db[key] = [u for u in queue if u != uid]
+                joins.pop(str(uid), None)
+                reply, changed = f"❌ Вы вышли из очереди {mode.upper()}", True
+
+            if changed:
+                save_db(db, key, ("queue_joins", uid))
+                # Запуск матча, если из очереди собирается лобби. В режиме "elo"
+                # окно может не включать нажавшего — матч объявляется в чате
+                # самого давнего игрока лобби, как в _matchmaking_tick.
+                mm     = MATCHMAKERS[mode]
+                window = mm.find_lobby() if MATCHMAKING == "elo" else None
+                if window:
+                    match_chat = mm.chat_for(window) or match_chat
+                match_players = take_lobby(db, mode)
+
+                # Открытые сообщения лобби обновит LOBBY_BOARDS при сохранении очереди.
+                # Старое сообщение не из реестра правим отдельно, чтобы не врало.
+                lobby = db.get("lobbies", {}).get(lobby_key(q.message.chat_id, mode))
+                if lobby is None or lobby["message_id"] != q.message.message_id:
+                    EDITS.submit(context.bot, q.message.chat_id, q.message.message_id,
+                                 lobby_text(mode, db.get(key, [])), lobby_kb(mode))
 
-        # Обновляем сообщение: кнопка меняется под того, кто нажал
         try:
-            await q.edit_message_text(
-                lobby_text(mode, queue),
-                reply_markup=lobby_kb(mode, uid, queue),
-                parse_mode=ParseMode.HTML
-            )
+            await q.answer(reply, show_alert=not changed)
         except Exception:
             pass
-
-        # Запуск матча если очередь полная
-        if len(queue) >= size:
-            match_players = queue[:size]
-            db[key]       = queue[size:]
-            save_db(db)
-            await start_match(match_players, mode, db, context, q.message.chat_id)
+        if match_players:
+            await start_match(match_players, mode, db, context, match_chat)
         return
 
     # ── PICK ────────────────────────────────────────────────────────────────
@@ -687,107 +3206,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             return
 
-        db = load_db()
-        m  = db["active_matches"].get(m_id)
-        if not m:
-            await q.answer("Матч уже завершён", show_alert=True); return
-
-        ct_cap = m["ct"][0]
-        t_cap  = m["t"][0]
-
-        # Только капитаны могут пикать
-        if uid not in (ct_cap, t_cap):
-            await q.answer("🚫 Только капитан может выбирать игроков!", show_alert=True); return
-
-        if uid != m["turn"]:
-            whose = get_player(m["turn"]).nickname
-            await q.answer(f"Сейчас ход {whose}!", show_alert=True); return
-
-        # Таймаут
-        if time.time() - m["pick_start_time"] > m["pick_timeout"]:
-            try:
-                await q.edit_message_text("⏰ Время на пик вышло! Матч отменён.")
-            except Exception:
-                pass
-            db["active_matches"].pop(m_id, None)
-            save_db(db)
-            return
-
-        if p_id not in m["pool"]:
-            await q.answer("Этот игрок уже выбран!", show_alert=True); return
-
-        # Добавляем в команду
-        if uid == ct_cap:
-            m["ct"].append(p_id)
-        else:
-            m["t"].append(p_id)
-        m["pool"].remove(p_id)
-
-        # Если остался 1 — авто-добавляем
-        if len(m["pool"]) == 1:
-            last = m["pool"].pop(0)
-            if len(m["ct"]) <= len(m["t"]):
-                m["ct"].append(last)
-            else:
-                m["t"].append(last)
-
-        if m["pool"]:
-            m["turn"]   = t_cap if uid == ct_cap else ct_cap
-            elapsed     = time.time() - m["pick_start_time"]
-            remaining   = max(0, int(m["pick_timeout"] - elapsed))
-            cur_side    = "🔵 CT" if m["turn"] == ct_cap else "🔴 T"
-            txt = (
-                f"🎯 <b>Пик | Матч #{m_id} [{m['mode'].upper()}]</b>\n"
-                f"CT: {len(m['ct'])} | T: {len(m['t'])}\n"
-                f"Ход: {cur_side}  ⏳ {remaining} сек"
-            )
-            try:
-                await q.edit_message_text(
-                    txt,
-                    reply_markup=InlineKeyboardMarkup(_pick_buttons(m_id, m["pool"])),
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
-            save_db(db)
-            # Если следующий ход — бот, запускаем авто-пик
-            if _is_bot_uid(m["turn"]):
-                await _bot_auto_pick(m_id, context, m.get("chat_id", q.message.chat_id))
-        else:
-            # Пик завершён → переходим к банам карт
-            m["phase"] = "ban"
-            m["turn"]  = ct_cap
-
-            def player_line(u: int) -> str:
-                p = get_player(u)
-                return f"  • {p.tg_link()} <code>[{p.external_id or '?'}]</code>"
-
-            ct_list = "\n".join(player_line(u) for u in m["ct"])
-            t_list  = "\n".join(player_line(u) for u in m["t"])
-            txt = (
-                f"✅ <b>Матч #{m_id} — пик завершён</b>\n\n"
-                f"🔵 CT:\n{ct_list}\n\n"
-                f"🔴 T:\n{t_list}\n\n"
-                f"🗺 <b>Баны карт — ход: 🔵 CT</b>"
-            )
-            ban_btns = [
-                [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
-                for mn in m["maps"]
-            ]
-            try:
-                await q.edit_message_text(
-                    txt,
-                    reply_markup=InlineKeyboardMarkup(ban_btns),
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception:
-                pass
-            save_db(db)
-            # Если капитан банов — бот, запускаем авто-бан
-            if _is_bot_uid(ct_cap):
-                await _bot_auto_ban(m_id, context, m.get("chat_id", q.message.chat_id))
-
-        save_db(db)
+        async with match_lock(m_id):
+            alert, edit = _pick_step(load_db(), m_id, uid, p_id,
+                                     context.job_queue, q.message.chat_id)
+        await _reply_callback(q, alert, edit)
         return
 
     # ── BAN MAP ─────────────────────────────────────────────────────────────
@@ -797,74 +3219,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         _, m_id, map_name = parts
 
-        db = load_db()
-        m  = db["active_matches"].get(m_id)
-        if not m:
-            await q.answer("Матч не найден", show_alert=True); return
-
-        ct_cap = m["ct"][0]
-        t_cap  = m["t"][0]
-
-        # Только капитаны банят карты
-        if uid not in (ct_cap, t_cap):
-            await q.answer("🚫 Только капитан может банить карты!", show_alert=True); return
-
-        if uid != m["turn"]:
-            whose = get_player(m["turn"]).nickname
-            await q.answer(f"Сейчас ход {whose}!", show_alert=True); return
-
-        if map_name not in m.get("maps", []):
-            await q.answer("Карта уже забанена", show_alert=True); return
-
-        m["maps"].remove(map_name)
-        m["banned_maps"].append(map_name)
-
-        if len(m["maps"]) == 1:
-            final_map  = m["maps"][0]
-            banned_str = ", ".join(m["banned_maps"])
-
-            def player_line(u: int) -> str:
-                p = get_player(u)
-                return f"  • {p.tg_link()} <code>[{p.external_id or '?'}]</code>"
-
-            ct_list = "\n".join(player_line(u) for u in m["ct"])
-            t_list  = "\n".join(player_line(u) for u in m["t"])
-            txt = (
-                f"🏁 <b>Матч #{m_id} [{m['mode'].upper()}] — всё готово!</b>\n\n"
-                f"🔵 CT:\n{ct_list}\n\n"
-                f"🔴 T:\n{t_list}\n\n"
-                f"🗺 Карта: <b>{final_map}</b>\n"
-                f"🚫 Забанены: {banned_str}\n\n"
-                f"Введите результат (только для администратора):\n"
-                f"<code>/win {m_id} ct</code>  или  <code>/win {m_id} t</code>"
-            )
-            try:
-                await q.edit_message_text(txt, parse_mode=ParseMode.HTML)
-            except Exception:
-                pass
-            save_db(db)
-            return
-
-        m["turn"] = t_cap if uid == ct_cap else ct_cap
-        cur_side  = "🔵 CT" if m["turn"] == ct_cap else "🔴 T"
-        ban_btns  = [
-            [InlineKeyboardButton(f"🚫 {mn}", callback_data=f"bn_{m_id}_{mn}")]
-            for mn in m["maps"]
-        ]
-        try:
-            await q.edit_message_text(
-                f"🗺 <b>Баны карт | Матч #{m_id}</b>\n"
-                f"Осталось: {len(m['maps'])} карт\n"
-                f"Ход: {cur_side}",
-                reply_markup=InlineKeyboardMarkup(ban_btns),
-                parse_mode=ParseMode.HTML
-            )
-        except Exception:
-            pass
-        save_db(db)
-        # Если следующий ход — бот, авто-бан
-        if _is_bot_uid(m["turn"]):
-            await _bot_auto_ban(m_id, context, m.get("chat_id", q.message.chat_id))
+        async with match_lock(m_id):
+            alert, edit = _ban_step(load_db(), m_id, uid, map_name,
+                                    context.job_queue, q.message.chat_id)
+        await _reply_callback(q, alert, edit)
 
 # ════════════════════════════════════════════════
 #              АДМИН-КОМАНДЫ
@@ -881,50 +3239,55 @@ async def win_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if side not in ("ct", "t"):
         await update.message.reply_text("Сторона: ct или t"); return
 
-    db = load_db()
-    m  = db["active_matches"].get(m_id)
-    if not m:
-        await update.message.reply_text(f"❌ Матч #{m_id} не найден"); return
-
-    winners = m["ct"] if side == "ct" else m["t"]
-    losers  = m["t"]  if side == "ct" else m["ct"]
-    w_nicks, l_nicks = [], []
-
-    for uid in winners + losers:
-        s = str(uid)
-        if s not in db["players"]:
-            db["players"][s] = asdict(Player(uid, "Unknown"))
-        for f, v in [("wins",0),("losses",0),("elo",1000),("avg",0.0),("is_bot",False)]:
-            db["players"][s].setdefault(f, v)
-
-    for uid in winners:
-        p = db["players"][str(uid)]
-        if not p.get("is_bot"):
-            p["wins"] += 1
-            p["elo"]  += ELO_WIN
-            total      = p["wins"] + p["losses"]
-            p["avg"]   = round(p["wins"] / total * 100, 1)
-        w_nicks.append(p.get("nickname","?"))
-
-    for uid in losers:
-        p = db["players"][str(uid)]
-        if not p.get("is_bot"):
-            p["losses"] += 1
-            p["elo"]     = max(ELO_MIN, p["elo"] - ELO_LOSS)
-            total        = p["wins"] + p["losses"]
-            p["avg"]     = round(p["wins"] / total * 100, 1) if total else 0.0
-        l_nicks.append(p.get("nickname","?"))
-
-    db["active_matches"].pop(m_id, None)
-    save_db(db)
-
-    mode = m.get("mode","5v5").upper()
+    async with match_lock(m_id):
+        db = load_db()
+        m  = db["active_matches"].get(m_id)
+        if not m:
+            await update.message.reply_text(f"❌ Матч #{m_id} не найден"); return
+
+        winners = m.ct if side == "ct" else m.t
+        losers  = m.t  if side == "ct" else m.ct
+
+        for uid in winners + losers:
+            s = str(uid)
+            if s not in db["players"]:
+                db["players"][s] = Player(uid, "Unknown")
+
+        model  = rating_model(db)
+        deltas = model.rate([db["players"][str(u)] for u in winners],
+                            [db["players"][str(u)] for u in losers])
+
+        for uid in winners + losers:
+            p = db["players"][str(uid)]
+            if not p.is_bot:
+                if uid in winners:
+                    p.wins += 1
+                else:
+                    p.losses += 1
+                p.avg = round(p.wins / (p.wins + p.losses) * 100, 1)
+
+        ratings = {s: db["players"][s].elo for s in deltas}
+        entry   = history_entry(m_id, m, side, deltas, ratings)
+        append_match_log(entry)
+        STATS.add(entry)
+        db["active_matches"].pop(m_id, None)
+        save_db(db, ("active_matches", m_id), *(("players", u) for u in winners + losers))
+
+    def nicks(uids):
+        out = []
+        for uid in uids:
+            p = db["players"][str(uid)]
+            d = deltas.get(str(uid))
+            out.append(p.nickname + (f" ({d:+d})" if d is not None else ""))
+        return ", ".join(out)
+
+    mode = m.mode.upper()
     await update.message.reply_text(
         f"✅ <b>Матч #{m_id} [{mode}] закрыт</b>\n\n"
         f"🏆 Победа {side.upper()}\n"
-        f"Победители: {', '.join(w_nicks)}\n"
-        f"Проигравшие: {', '.join(l_nicks)}\n\n"
-        f"📈 +{ELO_WIN} ELO победителям / -{ELO_LOSS} ELO проигравшим",
+        f"Победители: {nicks(winners)}\n"
+        f"Проигравшие: {nicks(losers)}\n\n"
+        f"📈 Рейтинг пересчитан по модели {model.name}",
         parse_mode=ParseMode.HTML
     )
 
@@ -945,7 +3308,7 @@ async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     db = load_db()
     db["muted"][str(target)] = datetime.now().timestamp() + duration
-    save_db(db)
+    save_db(db, ("muted", str(target)))
     await update.message.reply_text(f"🔇 Пользователь {target} замьючен на {duration//60} мин.")
 
 
@@ -960,7 +3323,7 @@ async def unmute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверный user_id"); return
     db = load_db()
     db["muted"].pop(str(target), None)
-    save_db(db)
+    save_db(db, ("muted", str(target)))
     await update.message.reply_text(f"🔊 Мут снят с {target}")
 
 
@@ -977,7 +3340,7 @@ async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = load_db()
     if len(context.args) >= 2 and context.args[1].lower() == "perm":
         db["banned"][str(target)] = 9_999_999_999
-        save_db(db)
+        save_db(db, ("banned", str(target)))
         await update.message.reply_text(f"🚫 Пользователь {target} перманентно забанен.")
         return
 
@@ -986,7 +3349,7 @@ async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверный формат. Примеры: 30m 2h 1d perm"); return
 
     db["banned"][str(target)] = datetime.now().timestamp() + duration
-    save_db(db)
+    save_db(db, ("banned", str(target)))
     await update.message.reply_text(f"🚫 Пользователь {target} забанен на {duration//3600} ч.")
 
 
@@ -1001,38 +3364,47 @@ async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверный user_id"); return
     db = load_db()
     db["banned"].pop(str(target), None)
-    save_db(db)
+    save_db(db, ("banned", str(target)))
     await update.message.reply_text(f"✅ Бан снят с {target}")
 
 
 async def elo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
-    db   = load_db()
-    rows = []
-    for d in db["players"].values():
-        if not d.get("external_id") or d.get("is_bot"):
-            continue
-        try:
-            p     = Player(**d)
-            total = p.wins + p.losses
-            wr    = f"{p.avg:.1f}%" if total else "—"
-            rows.append((p.nickname, p.external_id, p.elo, wr, total, p.lvl_icon()))
-        except Exception:
-            continue
-    if not rows:
+    load_db()
+    total = len(LEADERBOARD)
+    if not total:
         await update.message.reply_text("Нет зарегистрированных игроков."); return
 
-    rows.sort(key=lambda x: x[2], reverse=True)
-    lines = ["📊 <b>ELO таблица</b>\n━━━━━━━━━━━━━━━━━━━━━"]
-    for i, (nick, ext_id, elo, wr, games, icon) in enumerate(rows[:30], 1):
+    pages = (total + ELO_PAGE_SIZE - 1) // ELO_PAGE_SIZE
+    try:
+        page = int(context.args[0]) if context.args else 1
+    except ValueError:
+        await update.message.reply_text("Формат: /elo [страница]"); return
+    page = min(max(page, 1), pages)
+
+    txt = RENDER_CACHE.get(("elo", page, PLAYERS_VERSION.version), lambda: _render_elo_page(page))
+    await update.message.reply_text(txt, parse_mode=ParseMode.HTML)
+
+
+def _render_elo_page(page: int) -> str:
+    total  = len(LEADERBOARD)
+    pages  = (total + ELO_PAGE_SIZE - 1) // ELO_PAGE_SIZE
+    offset = (page - 1) * ELO_PAGE_SIZE
+    ids    = LEADERBOARD.top(ELO_PAGE_SIZE, offset)
+    ps     = get_players(ids)
+    lines  = [f"📊 <b>ELO таблица</b>  стр. {page}/{pages}\n━━━━━━━━━━━━━━━━━━━━━"]
+    for i, uid in enumerate(ids, offset + 1):
+        p     = ps[uid]
+        games = p.wins + p.losses
+        wr    = f"{p.avg:.1f}%" if games else "—"
         lines.append(
-            f"{i:2}. {icon} {nick} <code>[{ext_id}]</code>\n"
-            f"    ELO: <b>{elo}</b> | WR: {wr} | Игр: {games}"
+            f"{i:2}. {p.lvl_icon()} {p.nickname} <code>[{p.external_id}]</code>\n"
+            f"    ELO: <b>{p.elo}</b> | WR: {wr} | Игр: {games}"
         )
-    if len(rows) > 30:
-        lines.append(f"\n... и ещё {len(rows)-30} игроков")
-    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    if page < pages:
+        lines.append(f"\n... и ещё {total - offset - len(ids)} игроков — /elo {page + 1}")
+    return "\n".join(lines)
 
 
 async def setelo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1051,12 +3423,112 @@ async def setelo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if s not in db["players"]:
         await update.message.reply_text("Игрок не найден"); return
 
-    db["players"][s]["elo"] = max(ELO_MIN, new_elo)
-    save_db(db)
+    db["players"][s].elo = max(ELO_MIN, new_elo)
+    save_db(db, ("players", s))
     p = get_player(target)
     await update.message.reply_text(f"✅ ELO игрока {p.nickname} → {new_elo}")
 
 
+async def automode_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    db = load_db()
+    if len(context.args) < 2 or context.args[0] not in ("5v5", "2v2") \
+            or context.args[1].lower() not in ("on", "off"):
+        state = ", ".join(
+            f"{mode}: {'вкл' if auto_balance_enabled(db, mode) else 'выкл'}" for mode in ("5v5", "2v2")
+        )
+        await update.message.reply_text(f"Формат: /automode <5v5|2v2> <on|off>\nСейчас — {state}")
+        return
+
+    mode, on = context.args[0], context.args[1].lower() == "on"
+    db.setdefault("settings", {}).setdefault("auto_balance", {})[mode] = on
+    save_db(db, "settings")
+    await update.message.reply_text(
+        f"⚖️ Автобаланс {mode.upper()}: {'включён — драфта не будет' if on else 'выключен — драфт капитанов'}"
+    )
+
+
+async def recalc_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    db = load_db()
+    if context.args:
+        name = context.args[0].lower()
+        if name not in RATING_MODELS:
+            await update.message.reply_text(
+                f"Формат: /recalc [{'|'.join(RATING_MODELS)}]\n"
+                f"Сейчас — {rating_model(db).name}"
+            ); return
+        db.setdefault("settings", {})["rating_model"] = name
+        save_db(db, "settings")
+
+    # Журнал проигрывается в потоке на копиях игроков; если за это время
+    # закрылся матч (журнал вырос) — пересчитываем заново, иначе его итог
+    # затёрся бы. Перенос в базу — на цикле, без await до save_db.
+    model = rating_model(db)
+    while True:
+        size    = match_log_size()
+        players = {s: replace(p) for s, p in db["players"].items()}
+        n, work = await asyncio.to_thread(recompute_ratings, players, model)
+        if match_log_size() == size:
+            break
+    changed = apply_ratings(db, work)
+    save_db(db, *(("players", s) for s in changed))
+    await update.message.reply_text(
+        f"🔄 Рейтинг пересчитан по модели {model.name}\n"
+        f"Матчей в журнале: {n}, игроков обновлено: {len(changed)}"
+    )
+
+
+async def setid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Формат: /setid <user_id> <FACEIT_ID>"); return
+    try:
+        target = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("Неверный user_id"); return
+    faceit_id = context.args[1]
+
+    db = load_db()
+    s  = str(target)
+    if s not in db["players"]:
+        await update.message.reply_text("Игрок не найден"); return
+
+    owner = EXTERNAL_IDS.get(faceit_id)
+    if owner is not None and owner != target:
+        await update.message.reply_text(f"🚫 Этот FACEIT ID уже занят игроком {owner}."); return
+
+    db["players"][s].external_id = faceit_id
+    save_db(db, ("players", s))
+    p = get_player(target)
+    await update.message.reply_text(
+        f"✅ FACEIT ID игрока {p.nickname} → <code>{faceit_id}</code>",
+        parse_mode=ParseMode.HTML
+    )
+
+
+async def faceit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    if not context.args:
+        await update.message.reply_text("Формат: /faceit <FACEIT_ID>"); return
+
+    load_db()
+    uid = EXTERNAL_IDS.get(context.args[0])
+    if uid is None:
+        await update.message.reply_text("Игрок с таким FACEIT ID не найден."); return
+    p = get_player(uid)
+    await update.message.reply_text(
+        f"{p.lvl_icon()} {p.tg_link()}\n"
+        f"🆔 <code>{p.external_id}</code> • user_id <code>{uid}</code>\n"
+        f"ELO: <b>{p.elo}</b> | Побед: {p.wins} | Поражений: {p.losses}",
+        parse_mode=ParseMode.HTML
+    )
+
+
 async def clearqueue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return
@@ -1064,15 +3536,21 @@ async def clearqueue_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     which = context.args[0].lower() if context.args else "all"
 
     # Удаляем ботов из базы при очистке очереди
-    for q_key in (["queue_5v5"] if which == "5v5" else
-                  ["queue_2v2"] if which == "2v2" else
-                  ["queue_5v5", "queue_2v2"]):
-        for uid in db.get(q_key, []):
-            if uid < 0:  # это бот
-                db["players"].pop(str(uid), None)
-        db[q_key] = []
-
-    save_db(db)
+    changes = []
+    async with queue_lock("2v2"), queue_lock("5v5"):
+        for q_key in (["queue_5v5"] if which == "5v5" else
+                      ["queue_2v2"] if which == "2v2" else
+                      ["queue_5v5", "queue_2v2"]):
+            for uid in db.get(q_key, []):
+                if uid < 0:  # это бот
+                    db["players"].pop(str(uid), None)
+                    changes.append(("players", uid))
+                if db.get("queue_joins", {}).pop(str(uid), None) is not None:
+                    changes.append(("queue_joins", uid))
+            db[q_key] = []
+            changes.append(q_key)
+
+        save_db(db, *changes)
     await update.message.reply_text(f"🗑 Очередь [{which}] очищена.")
 
 
@@ -1084,17 +3562,140 @@ async def matches_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not matches:
         await update.message.reply_text("Нет активных матчей."); return
     lines = [f"📋 <b>Активные матчи ({len(matches)})</b>"]
+    caps  = get_players([u for m in matches.values() for u in (m.ct[:1] + m.t[:1])])
     for m_id, m in matches.items():
-        ct_n  = get_player(m["ct"][0]).nickname if m["ct"] else "?"
-        t_n   = get_player(m["t"][0]).nickname  if m["t"]  else "?"
-        phase = m.get("phase","?")
+        ct_n  = caps[m.ct[0]].nickname if m.ct else "?"
+        t_n   = caps[m.t[0]].nickname  if m.t  else "?"
+        phase = m.phase
+        lines.append(
+            f"#{m_id} [{m.mode.upper()}] "
+            f"{ct_n} vs {t_n} | {phase} | пул: {len(m.pool)}"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    try:
+        n   = int(context.args[0]) if context.args else 10
+        uid = int(context.args[1]) if len(context.args) > 1 else None
+    except ValueError:
+        await update.message.reply_text("Формат: /history [кол-во] [user_id]"); return
+
+    # Журнал читается потоком, в памяти держатся только последние n записей
+    last = deque(iter_match_log(uid=uid), maxlen=max(1, min(n, 50)))
+    if not last:
+        await update.message.reply_text("Журнал матчей пуст."); return
+    lines = [f"📜 <b>Последние матчи ({len(last)})</b>"]
+    for e in reversed(last):
+        closed = entry_times(e)[3]
+        when   = datetime.fromtimestamp(closed).strftime("%d.%m %H:%M") if closed else "?"
+        lines.append(
+            f"#{e['id']} [{e.get('mode','5v5').upper()}] {when} | "
+            f"{e.get('map') or '?'} | победа {e.get('side','?').upper()}"
+        )
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+
+def _write_history_csv(path: str, mode: Optional[str]) -> int:
+    rows = -1
+    with open(path, "w", encoding="utf-8") as f:
+        for line in export_history_csv(mode):
+            f.write(line)
+            rows += 1
+    return rows
+
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    mode = context.args[0] if context.args and context.args[0] in ("5v5", "2v2") else None
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    os.close(fd)
+    try:
+        rows = await asyncio.to_thread(_write_history_csv, path, mode)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f, filename=f"matches_{mode or 'all'}.csv",
+                caption=f"📦 Матчей в выгрузке: {rows}"
+            )
+    finally:
+        os.remove(path)
+
+
+def _ms(seconds: float) -> str:
+    return "∞" if seconds == float("inf") else f"{seconds * 1000:g}"
+
+
+async def perf_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    c  = lambda name: sum(v for (n, _), v in METRICS.counters.items() if n == name)
+    db = load_db()
+
+    lines = ["📊 <b>Производительность</b>", "", "<b>Обработчики</b> (вызовов · p50 · p99 · всего):"]
+    handlers = [(dict(lb)["handler"], h) for (n, lb), h in METRICS.histograms.items()
+                if n == "faceit_handler_seconds" and h.count]
+    for name, h in sorted(handlers, key=lambda kv: -kv[1].sum)[:10]:
         lines.append(
-            f"#{m_id} [{m.get('mode','?').upper()}] "
-            f"{ct_n} vs {t_n} | {phase} | пул: {len(m['pool'])}"
+            f"  <code>{name}</code>: {h.count} · ≤{_ms(h.quantile(.5))} мс · "
+            f"≤{_ms(h.quantile(.99))} мс · {h.sum:.2f} с"
         )
+    errors = c("faceit_handler_errors_total")
+    if errors:
+        lines.append(f"  ⚠️ исключений: {errors:g}")
+
+    w = METRICS.histogram("faceit_db_write_seconds")
+    lines += [
+        "",
+        f"<b>База</b>: загрузок {c('faceit_db_loads_total'):g} "
+        f"({c('faceit_db_load_bytes_total') / 1024:.0f} КБ), "
+        f"записей {c('faceit_db_records_total'):g} в {w.count} пачках "
+        f"({c('faceit_db_write_bytes_total') / 1024:.0f} КБ, p99 ≤{_ms(w.quantile(.99))} мс), "
+        f"свёрток {c('faceit_db_compactions_total'):g} "
+        f"({c('faceit_db_compact_bytes_total') / 1024:.0f} КБ)",
+    ]
+
+    api = [h for (n, _), h in METRICS.histograms.items() if n == "faceit_api_seconds"]
+    calls, total = sum(h.count for h in api), sum(h.sum for h in api)
+    lines.append(
+        f"<b>Bot API</b>: вызовов {calls}, в среднем {total / calls * 1000 if calls else 0:.0f} мс, "
+        f"ошибок {c('faceit_api_failures_total'):g}"
+    )
+    lines.append(
+        f"<b>Сейчас</b>: очередь 5v5 — {len(db.get('queue_5v5', []))}, "
+        f"2v2 — {len(db.get('queue_2v2', []))}, матчей — {len(db['active_matches'])}, "
+        f"правок в ожидании — {len(EDITS._pending)}"
+    )
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    app = context.application
+    if context.args and context.args[0] == "stop":
+        if not PROFILER.active:
+            await update.message.reply_text("Профилирование не запущено."); return
+        await PROFILER.finish(app)
+        return
+    if PROFILER.active:
+        await update.message.reply_text(
+            f"🔬 Уже идёт: осталось {PROFILER.remaining} апдейтов. /profile stop — выгрузить сейчас."
+        ); return
+    try:
+        updates = int(context.args[0]) if context.args else PROFILE_UPDATES
+        seconds = float(context.args[1]) if len(context.args) > 1 else PROFILE_SECONDS
+    except ValueError:
+        await update.message.reply_text("Формат: /profile [апдейтов] [секунд] | /profile stop"); return
+
+    PROFILER.start(app, max(1, updates), max(1.0, seconds), update.message.chat_id)
+    await update.message.reply_text(
+        f"🔬 Профилирую следующие {updates} апдейтов (не дольше {seconds:g} с)."
+    )
+
+
 # ── /bots1 — 5v5: 1 реальный игрок + 9 ботов ────────────────────────────────
 # ── /bots2 — 2v2: 1 реальный игрок + 3 бота  ────────────────────────────────
 # Обе команды секретные, не видны в меню. Боты НЕ попадают в /top, /stats, /elo.
@@ -1115,7 +3716,7 @@ def _create_fake_bot(db: Dict) -> int:
     wins     = random.randint(0, 60)
     losses   = random.randint(0, 60)
     avg      = round(wins / (wins + losses) * 100, 1) if (wins + losses) else 0.0
-    db["players"][str(bot_uid)] = asdict(Player(
+    db["players"][str(bot_uid)] = Player(
         user_id     = bot_uid,
         nickname    = bot_nick,
         external_id = f"bot_{db['bot_counter']}",
@@ -1124,7 +3725,7 @@ def _create_fake_bot(db: Dict) -> int:
         losses      = losses,
         avg         = avg,
         is_bot      = True
-    ))
+    )
     return bot_uid
 
 
@@ -1138,21 +3739,23 @@ async def bots1_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS:
         return  # молча игнорируем
 
-    db    = load_db()
-    uid   = update.effective_user.id
-    queue = db.get("queue_5v5", [])
+    db  = load_db()
+    uid = update.effective_user.id
 
-    # Реальный игрок — берём из очереди или добавляем самого вызывающего
-    if uid in queue:
-        queue.remove(uid)
-    real_players = [uid]
+    async with queue_lock("5v5"):
+        queue = db.get("queue_5v5", [])
 
-    # Добавляем 9 ботов
-    for _ in range(LOBBY_5V5_SIZE - 1):
-        real_players.append(_create_fake_bot(db))
+        # Реальный игрок — берём из очереди или добавляем самого вызывающего
+        if uid in queue:
+            queue.remove(uid)
+        real_players = [uid]
+
+        # Добавляем 9 ботов
+        for _ in range(LOBBY_5V5_SIZE - 1):
+            real_players.append(_create_fake_bot(db))
 
-    db["queue_5v5"] = queue  # очередь не трогаем
-    save_db(db)
+        db["queue_5v5"] = queue  # очередь не трогаем
+        save_db(db, "queue_5v5", "bot_counter", *(("players", u) for u in real_players[1:]))
 
     await update.message.reply_text(
         f"🤖 Тестовый матч 5v5 запускается!\n"
@@ -1179,7 +3782,7 @@ async def bots2_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for _ in range(LOBBY_2V2_SIZE - 1):
         real_players.append(_create_fake_bot(db))
 
-    save_db(db)
+    save_db(db, "bot_counter", *(("players", u) for u in real_players[1:]))
 
     await update.message.reply_text(
         f"🤖 Тестовый матч 2v2 запускается!\n"
@@ -1192,6 +3795,62 @@ async def bots2_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 #              МЕНЮ КОМАНД (только публичные)
 # ════════════════════════════════════════════════
 
+def register_gauges(app: Application) -> None:
+    modes = ("5v5", "2v2")
+    METRICS.gauge("faceit_queue_depth",
+                  lambda: {f'mode="{m}"': len(load_db().get(f"queue_{m}", [])) for m in modes},
+                  "Игроков в очереди")
+    METRICS.gauge("faceit_active_matches", lambda: len(load_db()["active_matches"]), "Активных матчей")
+    METRICS.gauge("faceit_players", lambda: len(load_db()["players"]), "Игроков в базе")
+    METRICS.gauge("faceit_pending_edits", lambda: len(EDITS._pending), "Правок лобби в ожидании")
+    METRICS.gauge("faceit_journal_records", lambda: STATE.storage.records, "Записей с последней свёртки")
+    processor = app.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        METRICS.gauge("faceit_updates_in_flight", lambda: processor.in_flight, "Апдейтов в обработке")
+
+
+async def on_startup(app: Application):
+    db = load_db()
+    STATE.start()
+    for board in LOBBY_BOARDS.values():
+        board.bot = app.bot
+    repair_match_log()
+    STATS.rebuild(iter_match_log())
+    # Таймеры пика/банов живут в памяти — после рестарта ставим их заново
+    for m_id in list(db["active_matches"]):
+        schedule_deadline(app.job_queue, m_id)
+    if MATCHMAKING == "elo":
+        app.job_queue.run_repeating(_matchmaking_tick, MM_TICK_INTERVAL, name="matchmaking")
+    app.bot_data["sanction_sweeper"] = asyncio.create_task(_sanction_sweeper(app.bot))
+    register_gauges(app)
+    if METRICS_PORT:
+        try:
+            app.bot_data["metrics_server"] = await asyncio.start_server(
+                _metrics_http, METRICS_HOST, METRICS_PORT
+            )
+        except OSError as e:
+            print(f"⚠️ Метрики недоступны на {METRICS_HOST}:{METRICS_PORT}: {e}")
+    await set_commands(app)
+
+
+async def on_stop(app: Application):
+    """
+    post_stop: апдейты и задачи уже доработали, но бот ещё не закрыт —
+    последние правки лобби ещё можно отправить.
+    """
+    server = app.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+    sweeper = app.bot_data.pop("sanction_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+    await EDITS.close(EDIT_WINDOW + EDIT_CHAT_INTERVAL * 2)
+
+
+async def on_shutdown(app: Application):
+    await STATE.stop()
+
+
 async def set_commands(app: Application):
     await app.bot.set_my_commands([
         BotCommand("start",  "Начало работы"),
@@ -1200,6 +3859,8 @@ async def set_commands(app: Application):
         BotCommand("play2",  "Лобби 2v2"),
         BotCommand("stats",  "Мой профиль"),
         BotCommand("top",    "Топ игроков"),
+        BotCommand("rank",   "Место в рейтинге"),
+        BotCommand("mapstats", "Статистика по картам"),
         BotCommand("queue",  "Статус очередей"),
         # /bots и все админские команды здесь НЕ указаны — они невидимы
     ])
@@ -1208,14 +3869,14 @@ async def set_commands(app: Application):
 #                    ЗАПУСК
 # ════════════════════════════════════════════════
 
-def main():
-    app = Application.builder().token(BOT_TOKEN).build()
-
+def add_handlers(app: Application) -> None:
     # Публичные команды
     app.add_handler(CommandHandler("start",  start_cmd))
     app.add_handler(CommandHandler("reg",    reg_cmd))
     app.add_handler(CommandHandler("stats",  stats_cmd))
     app.add_handler(CommandHandler("top",    top_cmd))
+    app.add_handler(CommandHandler("rank",   rank_cmd))
+    app.add_handler(CommandHandler("mapstats", mapstats_cmd))
     app.add_handler(CommandHandler("play5",  play5_cmd))
     app.add_handler(CommandHandler("play2",  play2_cmd))
     app.add_handler(CommandHandler("queue",  queue_cmd))
@@ -1228,22 +3889,126 @@ def main():
     app.add_handler(CommandHandler("unban",      unban_cmd))
     app.add_handler(CommandHandler("elo",        elo_cmd))
     app.add_handler(CommandHandler("setelo",     setelo_cmd))
+    app.add_handler(CommandHandler("setid",      setid_cmd))
+    app.add_handler(CommandHandler("automode",   automode_cmd))
+    app.add_handler(CommandHandler("recalc",     recalc_cmd))
+    app.add_handler(CommandHandler("faceit",     faceit_cmd))
     app.add_handler(CommandHandler("clearqueue", clearqueue_cmd))
     app.add_handler(CommandHandler("matches",    matches_cmd))
+    app.add_handler(CommandHandler("history",    history_cmd))
+    app.add_handler(CommandHandler("export",     export_cmd))
+    app.add_handler(CommandHandler("perf",       perf_cmd))
+    app.add_handler(CommandHandler("profile",    profile_cmd))
     app.add_handler(CommandHandler("bots1",      bots1_cmd))   # ← секретная: 5v5 тест
     app.add_handler(CommandHandler("bots2",      bots2_cmd))   # ← секретная: 2v2 тест
 
     app.add_handler(CallbackQueryHandler(callback_handler))
+    instrument_handlers(app)
+
+
+def fake_update(text: str, uid: int) -> Dict[str, Any]:
+    """Апдейт в формате Bot API: сообщение/команда или нажатие кнопки (cb:<data>)."""
+    now  = int(time.time())
+    user = {"id": uid, "is_bot": False, "first_name": "Test"}
+    chat = {"id": uid, "type": "private", "first_name": "Test"}
+    msg  = {"message_id": random.randint(1, 2**31), "date": now, "chat": chat, "from": user}
+    upd: Dict[str, Any] = {"update_id": random.randint(1, 2**31)}
+    if text.startswith("cb:"):
+        upd["callback_query"] = {
+            "id": str(upd["update_id"]), "from": user, "chat_instance": str(uid),
+            "message": dict(msg, text="lobby"), "data": text[3:],
+        }
+    else:
+        msg["text"] = text
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        upd["message"] = msg
+    return upd
 
-    app.post_init = set_commands
 
-    print("🤖 Бот запускается...")
-    app.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True,
-        poll_interval=0.5,
-        timeout=10,
-    )
+def post_fake_update(url: str, update: Dict[str, Any]) -> int:
+    import httpx   # ставится вместе с python-telegram-bot
+    r = httpx.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET})
+    return r.status_code
+
+
+def main():
+    # python faceit_bot.py migrate — перенос faceit_db.json в SQLite
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        n = migrate_json_to_sqlite()
+        print(f"✅ Перенесено записей: {n} → {SQLITE_FILE}")
+        print('   Переключите DB_BACKEND = "sqlite" и перезапустите бота.')
+        return
+
+    # python faceit_bot.py export [5v5|2v2] > matches.csv — выгрузка журнала матчей
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        mode = sys.argv[2] if len(sys.argv) > 2 else None
+        for line in export_history_csv(mode):
+            sys.stdout.write(line)
+        return
+
+    # python faceit_bot.py fake-update [url] "/play5" [user_id] — прислать вебхуку
+    # синтетический апдейт (локальная проверка без Telegram). "cb:join_5v5" — нажатие кнопки.
+    if len(sys.argv) > 1 and sys.argv[1] == "fake-update":
+        args = sys.argv[2:]
+        url  = args.pop(0) if args and args[0].startswith("http") else \
+            f"http://127.0.0.1:{WEBHOOK_PORT}/{WEBHOOK_PATH}"
+        text = args[0] if args else "/start"
+        uid  = int(args[1]) if len(args) > 1 else ADMIN_IDS[0]
+        try:
+            print(f"→ {url}: HTTP {post_fake_update(url, fake_update(text, uid))}")
+        except Exception as e:
+            print(f"❌ {url}: {e}")
+        return
+
+    # python faceit_bot.py recalc [elo|glicko2|flat] — пересчёт рейтинга без запуска бота
+    if len(sys.argv) > 1 and sys.argv[1] == "recalc":
+        repair_match_log()
+        db = load_db()
+        if len(sys.argv) > 2:
+            if sys.argv[2] not in RATING_MODELS:
+                print(f"Модели: {', '.join(RATING_MODELS)}"); return
+            db.setdefault("settings", {})["rating_model"] = sys.argv[2]
+            save_db(db, "settings")
+        model   = rating_model(db)
+        n, work = recompute_ratings(db["players"], model)
+        changed = apply_ratings(db, work)
+        save_db(db, *(("players", s) for s in changed))
+        asyncio.run(STATE.stop())
+        print(f"✅ {model.name}: матчей {n}, игроков обновлено {len(changed)}")
+        return
+
+    builder = Application.builder().token(BOT_TOKEN).request(MeteredRequest(connection_pool_size=256))
+    if CONCURRENT_UPDATES:
+        builder = builder.concurrent_updates(
+            ChatOrderedUpdateProcessor(UPDATE_WORKERS, UPDATE_BACKLOG)
+        )
+    app = builder.build()
+
+    add_handlers(app)
+
+    app.post_init     = on_startup
+    app.post_stop     = on_stop
+    app.post_shutdown = on_shutdown
+
+    print(f"🤖 Бот запускается ({UPDATE_MODE})...")
+    if UPDATE_MODE == "webhook":
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+        )
+    else:
+        app.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+            poll_interval=0.0,
+            timeout=10,
+        )
     print("✅ Бот остановлен.")
 
 
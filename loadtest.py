@@ -0,0 +1,272 @@
+"""
+Нагрузочный прогон бота без Telegram.
+
+Настоящие обработчики faceit_bot (через Application, с тем же
+ChatOrderedUpdateProcessor, JobQueue и хранилищем) получают тысячи
+синтетических апдейтов. Сеть подменена FakeRequest: Bot API отвечает
+мгновенно (или с заданной задержкой), ничего никуда не уходит.
+База и журнал матчей пишутся во временный каталог.
+
+Сценарий: N лобби = N групповых чатов по 10 игроков. Все игроки
+регистрируются, в каждом чате открывается /play5, дальше R раундов:
+все жмут «Присоединиться», капитаны пикуют и банят, админ закрывает
+матчи через /win.
+
+    python loadtest.py --lobbies 50 --rounds 3
+    python loadtest.py --lobbies 20 --backend sqlite --api-latency 30
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import faceit_bot as fb
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+ADMIN    = fb.ADMIN_IDS[0]
+
+
+class FakeRequest(BaseRequest):
+    """Сетевой слой Bot API в памяти: считает вызовы и отвечает правдоподобным JSON."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency     = latency
+        self.calls       = Counter()
+        self._message_id = 0
+        self._closed     = False
+
+    async def initialize(self) -> None:
+        self._closed = False
+
+    async def shutdown(self) -> None:
+        self._closed = True
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        if self._closed:   # как HTTPXRequest: после shutdown() запросы не уходят
+            raise RuntimeError("This FakeRequest is not initialized!")
+        endpoint = url.rsplit("/", 1)[-1]
+        params   = request_data.parameters if request_data is not None else {}
+        self.calls[endpoint] += 1
+        if self.latency and endpoint != "getUpdates":
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint: str, p: Dict[str, Any]) -> Any:
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getUpdates":
+            return []
+        if endpoint in ("sendMessage", "sendDocument", "editMessageText"):
+            if "message_id" not in p:
+                self._message_id += 1
+            return {
+                "message_id": p.get("message_id", self._message_id),
+                "date":       int(time.time()),
+                "chat":       {"id": int(p.get("chat_id", 0)), "type": "group", "title": "load"},
+                "from":       BOT_USER,
+                "text":       p.get("text", ""),
+            }
+        return True
+
+
+class Updates:
+    """Фабрика синтетических апдейтов в формате Bot API."""
+
+    def __init__(self, bot):
+        self.bot     = bot
+        self.next_id = 0
+
+    def _user(self, uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    def _chat(self, chat_id: int) -> Dict[str, Any]:
+        return {"id": chat_id, "type": "group", "title": f"lobby{chat_id}"}
+
+    def message(self, chat_id: int, uid: int, text: str) -> Update:
+        self.next_id += 1
+        msg = {
+            "message_id": self.next_id, "date": int(time.time()),
+            "chat": self._chat(chat_id), "from": self._user(uid), "text": text,
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": self.next_id, "message": msg}, self.bot)
+
+    def callback(self, chat_id: int, uid: int, data: str, message_id: int = 1) -> Update:
+        self.next_id += 1
+        return Update.de_json({
+            "update_id": self.next_id,
+            "callback_query": {
+                "id": str(self.next_id), "from": self._user(uid),
+                "chat_instance": str(chat_id), "data": data,
+                "message": {
+                    "message_id": message_id, "date": int(time.time()),
+                    "chat": self._chat(chat_id), "from": BOT_USER, "text": "lobby",
+                },
+            },
+        }, self.bot)
+
+
+class Timings:
+    """Время выполнения каждого обработчика, по имени колбэка."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def wrap(self, app: Application) -> None:
+        for handlers in app.handlers.values():
+            for h in handlers:
+                h.callback = self._timed(h.callback)
+
+    def _timed(self, callback):
+        samples = self.samples.setdefault(callback.__name__, [])
+
+        async def timed(update, context):
+            t0 = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                samples.append(time.perf_counter() - t0)
+        return timed
+
+
+def percentile(values: List[float], q: float) -> float:
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))] if s else 0.0
+
+
+async def feed(app: Application, updates: List[Update]) -> None:
+    """Отдаёт пачку апдейтов приложению и ждёт, пока все будут обработаны."""
+    for u in updates:
+        await app.update_queue.put(u)
+    await app.update_queue.join()
+
+
+def match_actions(ups: Updates) -> List[Update]:
+    """Следующий ход в каждом активном матче — так, как его сделал бы капитан."""
+    db  = fb.load_db()
+    out = []
+    for m_id, m in list(db["active_matches"].items()):
+        chat = m.chat_id
+        if m.phase == "pick" and m.pool:
+            out.append(ups.callback(chat, m.turn, f"pk_{m_id}_{random.choice(m.pool)}"))
+        elif m.phase == "ban" and len(m.maps) > 1:
+            out.append(ups.callback(chat, m.turn, f"bn_{m_id}_{random.choice(m.maps)}"))
+        elif len(m.maps) == 1:
+            out.append(ups.message(chat, ADMIN, f"/win {m_id} {random.choice(['ct', 't'])}"))
+    return out
+
+
+async def run(args) -> Dict[str, Any]:
+    tmp = tempfile.mkdtemp(prefix="faceit_load_")
+    fb.DATA_FILE      = os.path.join(tmp, "db.json")
+    fb.JOURNAL_FILE   = os.path.join(tmp, "db.journal")
+    fb.SQLITE_FILE    = os.path.join(tmp, "db.sqlite3")
+    fb.MATCH_LOG_FILE = os.path.join(tmp, "matches.jsonl")
+    fb.STATE.backend_kind = args.backend
+    fb.METRICS_PORT = 0
+    fb.MM_MAX_WAIT = 0   # лобби собирается сразу, без ожидания расширения окна ELO
+
+    request = FakeRequest(args.api_latency / 1000)
+    app = (
+        Application.builder()
+        .token("123456:LOADTEST")
+        .request(request)
+        .get_updates_request(FakeRequest())
+        .concurrent_updates(fb.ChatOrderedUpdateProcessor(
+            fb.UPDATE_WORKERS, fb.UPDATE_BACKLOG))
+        .updater(None)
+        .build()
+    )
+    fb.add_handlers(app)
+    timings = Timings()
+    timings.wrap(app)
+
+    await app.initialize()
+    await fb.on_startup(app)
+    await app.start()
+
+    ups     = Updates(app.bot)
+    chats   = [-1000 - i for i in range(args.lobbies)]
+    members = {c: [10_000 + i * 10 + j for j in range(fb.LOBBY_5V5_SIZE)] for c, i in zip(chats, range(args.lobbies))}
+    total   = 0
+    t0      = time.perf_counter()
+
+    regs = [ups.message(c, u, f"/reg fc{u} Player{u}") for c in chats for u in members[c]]
+    await feed(app, regs)
+    await feed(app, [ups.message(c, members[c][0], "/play5") for c in chats])
+    total += len(regs) + len(chats)
+
+    for _ in range(args.rounds):
+        lobbies = fb.load_db()["lobbies"]
+        joins = [
+            ups.callback(c, u, "join_5v5", lobbies[fb.lobby_key(c, "5v5")]["message_id"])
+            for c in chats for u in members[c]
+        ]
+        random.shuffle(joins)
+        await feed(app, joins)
+        total += len(joins)
+        while True:
+            batch = match_actions(ups)
+            if not batch:
+                break
+            await feed(app, batch)
+            total += len(batch)
+        await feed(app, [ups.message(c, members[c][0], "/top") for c in chats])
+        total += len(chats)
+
+    wall = time.perf_counter() - t0
+    # Порядок как в run_polling: stop → post_stop → shutdown → post_shutdown
+    await app.stop()
+    await fb.on_stop(app)
+    await app.shutdown()
+    await fb.on_shutdown(app)
+
+    return {
+        "tmp": tmp, "updates": total, "wall": wall, "timings": timings.samples,
+        "api": request.calls, "matches": sum(1 for _ in fb.iter_match_log()),
+    }
+
+
+def report(r: Dict[str, Any]) -> None:
+    print(f"\nАпдейтов: {r['updates']} за {r['wall']:.2f} с — {r['updates'] / r['wall']:.0f} апд/с")
+    print(f"Сыграно матчей: {r['matches']}")
+    print(f"\n{'обработчик':<18}{'вызовов':>9}{'p50, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+    for name, s in sorted(r["timings"].items(), key=lambda kv: -len(kv[1])):
+        if s:
+            print(f"{name:<18}{len(s):>9}{percentile(s, .5) * 1e3:>10.2f}"
+                  f"{percentile(s, .99) * 1e3:>10.2f}{max(s) * 1e3:>10.2f}")
+    c = lambda name: sum(v for (n, _), v in fb.METRICS.counters.items() if n == name)
+    written = c("faceit_db_write_bytes_total") + c("faceit_db_compact_bytes_total")
+    print(f"\nБаза: записей {c('faceit_db_records_total'):g}, "
+          f"свёрток {c('faceit_db_compactions_total'):g}, записано {written / 1024:.1f} КБ")
+    print(f"Правки лобби: отправлено {fb.EDITS.edits}, схлопнуто/пропущено {fb.EDITS.skipped}")
+    print("Bot API: " + ", ".join(f"{k} {v}" for k, v in r["api"].most_common()))
+    print(f"Файлы прогона: {r['tmp']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон faceit_bot на синтетических апдейтах")
+    ap.add_argument("--lobbies", type=int, default=20, help="параллельных лобби (чатов по 10 игроков)")
+    ap.add_argument("--rounds",  type=int, default=3,  help="матчей на каждое лобби")
+    ap.add_argument("--backend", choices=("json", "sqlite"), default=fb.DB_BACKEND)
+    ap.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа Bot API, мс")
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    report(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()